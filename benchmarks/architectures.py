@@ -0,0 +1,285 @@
+"""Benchmark of the built-in inline handlers on x86_64 and arm64.
+
+Runs the handlers in the Lambda Python base image, once per platform, with
+synthetic events generated from a fixed seed. The platform that doesn't
+match the host runs under QEMU emulation, which docker needs registered
+first (e.g. docker run --privileged --rm tonistiigi/binfmt --install all)::
+
+    python -m benchmarks.architectures --invocations 200
+
+Handlers calling AWS on every invocation (the forwarder and publisher
+sends, the relays, the sweeper and the auth challenge SMS) are measured
+through their CPU bound parts only. Emulated timings are far slower than
+the hardware they stand for: compare handlers within a column, and time
+the architecture natively (--host on an x86_64 and on a Graviton machine)
+before weighing the price per ms.
+"""
+import os
+import sys
+import json
+import base64
+import random
+import typing
+import argparse
+import tempfile
+import subprocess
+
+from domainpy_aws_cdk.auth import (
+    PRE_SIGNUP_CODE,
+    DEFINE_AUTH_CHALLENGE,
+    VERIFY_AUTH_CHALLENGE_CODE,
+)
+from domainpy_aws_cdk.xcom import (
+    EVENT_STORE_RECORD_DECODER_CODE,
+    STREAM_PUBLISHER_CODE,
+)
+from domainpy_aws_cdk.constructs.aws_kinesisfirehose import TRANSFORMER_CODE
+
+from .forwarder_decoder import make_new_image
+
+
+PLATFORMS = {"x86_64": "linux/amd64", "arm64": "linux/arm64"}
+
+# Runs inside the container, without the package, from the files written
+# by write_cases
+DRIVER_CODE = """
+import os
+import sys
+import json
+import time
+import platform
+import collections
+import importlib.util
+
+path = os.path.dirname(os.path.abspath(__file__))
+repeat = int(sys.argv[1])
+
+with open(os.path.join(path, "cases.json")) as file:
+    cases = json.load(file)
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+results = {}
+for case in cases:
+    os.environ.update(case["environment"])
+    spec = importlib.util.spec_from_file_location(
+        case["name"], os.path.join(path, case["module"])
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    function = getattr(module, case["function"])
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for args in case["calls"]:
+            result = function(*args)
+            if case.get("generator"):
+                collections.deque(result, maxlen=0)
+        best = min(best, time.perf_counter() - start)
+    results[case["name"]] = best / len(case["calls"])
+
+print(json.dumps({"machine": platform.machine(), "results": results}))
+"""
+
+
+def make_firehose_event(records: int) -> dict:
+    return {
+        "records": [
+            {
+                "recordId": str(i),
+                "data": base64.b64encode(
+                    json.dumps(make_new_image(5)).encode("utf-8")
+                ).decode("ascii"),
+            }
+            for i in range(records)
+        ]
+    }
+
+
+def make_publisher_entries(entries: int) -> typing.List[dict]:
+    return [
+        {
+            "Id": str(i),
+            "Message": json.dumps(
+                {"type": "EVENT", "message": make_new_image(10)}
+            ),
+            "MessageAttributes": {
+                "topic": {"DataType": "String", "StringValue": "Topic"},
+                "context": {"DataType": "String", "StringValue": "context"},
+            },
+            "MessageGroupId": f"trace-{i % 10}",
+            "MessageDeduplicationId": f"message-{i}",
+        }
+        for i in range(entries)
+    ]
+
+
+def make_auth_event(session: int) -> dict:
+    return {
+        "request": {
+            "session": [
+                {"challengeName": "CUSTOM_CHALLENGE", "challengeResult": False}
+                for _ in range(session)
+            ],
+            "challengeAnswer": "1234",
+            "privateChallengeParameters": {"expectedAnswer": "1234"},
+        },
+        "response": {},
+    }
+
+
+def write_cases(path: str, invocations: int) -> None:
+    handlers = {
+        "firehose_transformer.py": TRANSFORMER_CODE,
+        "forwarder_decoder.py": EVENT_STORE_RECORD_DECODER_CODE,
+        "stream_publisher.py": STREAM_PUBLISHER_CODE,
+        "auth_pre_signup.py": PRE_SIGNUP_CODE,
+        "auth_define_challenge.py": DEFINE_AUTH_CHALLENGE,
+        "auth_verify_challenge.py": VERIFY_AUTH_CHALLENGE_CODE,
+    }
+    for module, source in handlers.items():
+        with open(os.path.join(path, module), "w") as file:
+            file.write(source)
+
+    def handler_calls(make_event: typing.Callable[[], dict]) -> list:
+        return [[make_event(), None] for _ in range(invocations)]
+
+    cases = [
+        {
+            "name": "firehose_transformer",
+            "module": "firehose_transformer.py",
+            "function": "handler",
+            "environment": {},
+            "calls": handler_calls(lambda: make_firehose_event(100)),
+        },
+        {
+            "name": "forwarder_decoder",
+            "module": "forwarder_decoder.py",
+            "function": "decode_message",
+            "environment": {},
+            "calls": [[make_new_image(20)] for _ in range(invocations)],
+        },
+        {
+            "name": "stream_publisher_batching",
+            "module": "stream_publisher.py",
+            "function": "make_batches",
+            "generator": True,
+            "environment": {"TRANSPORT": "sns-fifo"},
+            "calls": [
+                [make_publisher_entries(100)]
+                for _ in range(max(invocations // 10, 1))
+            ],
+        },
+        {
+            "name": "auth_pre_signup",
+            "module": "auth_pre_signup.py",
+            "function": "handler",
+            "environment": {},
+            "calls": handler_calls(lambda: make_auth_event(0)),
+        },
+        {
+            "name": "auth_define_challenge",
+            "module": "auth_define_challenge.py",
+            "function": "handler",
+            "environment": {"MAX_ATTEMPTS": "3"},
+            "calls": handler_calls(lambda: make_auth_event(2)),
+        },
+        {
+            "name": "auth_verify_challenge",
+            "module": "auth_verify_challenge.py",
+            "function": "handler",
+            "environment": {},
+            "calls": handler_calls(lambda: make_auth_event(1)),
+        },
+    ]
+    with open(os.path.join(path, "cases.json"), "w") as file:
+        json.dump(cases, file)
+
+    with open(os.path.join(path, "driver.py"), "w") as file:
+        file.write(DRIVER_CODE)
+
+
+def run_in_docker(path: str, image: str, platform: str, repeat: int) -> dict:
+    import docker
+
+    client = docker.from_env()
+    output = client.containers.run(
+        image=image,
+        entrypoint="python3",
+        command=["/var/benchmark/driver.py", str(repeat)],
+        platform=platform,
+        volumes={path: {"bind": "/var/benchmark", "mode": "ro"}},
+        remove=True,
+    )
+    return json.loads(output)
+
+
+def run_on_host(path: str, repeat: int) -> dict:
+    output = subprocess.run(
+        [sys.executable, os.path.join(path, "driver.py"), str(repeat)],
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    return json.loads(output)
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--invocations", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--image", default="public.ecr.aws/lambda/python:3.8")
+    parser.add_argument(
+        "--architectures",
+        nargs="+",
+        choices=sorted(PLATFORMS),
+        default=["x86_64", "arm64"],
+    )
+    parser.add_argument(
+        "--host",
+        action="store_true",
+        help="run with the local interpreter instead of docker",
+    )
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+
+    columns: typing.Dict[str, typing.Dict[str, float]] = {}
+    with tempfile.TemporaryDirectory() as path:
+        write_cases(path, args.invocations)
+
+        if args.host:
+            output = run_on_host(path, args.repeat)
+            columns[f"host {output['machine']}"] = output["results"]
+        else:
+            for architecture in args.architectures:
+                output = run_in_docker(
+                    path, args.image, PLATFORMS[architecture], args.repeat
+                )
+                columns[architecture] = output["results"]
+
+    names = list(next(iter(columns.values())))
+    print(f"us per invocation, best of {args.repeat}")
+    print(f"{'handler':<28}" + "".join(f"{c:>16}" for c in columns))
+    for name in names:
+        print(
+            f"{name:<28}"
+            + "".join(
+                f"{results[name] * 10**6:>16.1f}"
+                for results in columns.values()
+            )
+        )
+
+    if len(columns) == 2:
+        first, second = columns
+        print(f"\n{second} / {first}")
+        for name in names:
+            ratio = columns[second][name] / columns[first][name]
+            print(f"{name:<28}{ratio:>16.2f}x")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""Micro-benchmark of the EventStoreSource forwarder record decoding.
+
+Decodes synthetic DynamoDB stream records into SNS message bodies with the
+TypeDeserializer based decoding the forwarder used before (when boto3 is
+installed) and with EVENT_STORE_RECORD_DECODER_CODE, with and without
+orjson (when installed), e.g.::
+
+    python -m benchmarks.forwarder_decoder --records 1000 --fields 50
+"""
+import sys
+import json
+import time
+import random
+import string
+import typing
+import decimal
+import argparse
+
+from domainpy_aws_cdk.xcom import EVENT_STORE_RECORD_DECODER_CODE
+
+
+def make_attribute(depth: int, fields: int) -> dict:
+    kinds = ["S", "N", "BOOL", "NULL", "M", "L"] if depth else ["S", "N"]
+    kind = random.choice(kinds)
+    if kind == "S":
+        return {"S": "".join(random.choices(string.ascii_letters, k=24))}
+    if kind == "N":
+        return {"N": str(round(random.uniform(-1e6, 1e6), 4))}
+    if kind == "BOOL":
+        return {"BOOL": random.random() > 0.5}
+    if kind == "NULL":
+        return {"NULL": True}
+    if kind == "M":
+        return {
+            "M": {
+                f"field{i}": make_attribute(depth - 1, fields // 4)
+                for i in range(max(fields // 4, 1))
+            }
+        }
+    return {
+        "L": [
+            make_attribute(depth - 1, fields // 4)
+            for _ in range(max(fields // 4, 1))
+        ]
+    }
+
+
+def make_new_image(fields: int) -> dict:
+    return {
+        "stream_id": {"S": "stream-" + str(random.randint(0, 1000))},
+        "number": {"N": str(random.randint(0, 1000))},
+        "topic": {"S": "Topic"},
+        "version": {"N": "1"},
+        "timestamp": {"N": str(time.time())},
+        "event": {
+            "M": {
+                f"field{i}": make_attribute(2, fields) for i in range(fields)
+            }
+        },
+        "is_snapshot": {"BOOL": False},
+        "message_id": {"S": "message-" + str(random.randint(0, 10**9))},
+        "correlation_id": {"NULL": True},
+        "trace_id": {"S": "trace-" + str(random.randint(0, 10**9))},
+        "context": {"S": "context"},
+    }
+
+
+def load_decoder(fast_json: bool) -> typing.Callable[[dict], typing.Any]:
+    namespace: typing.Dict[str, typing.Any] = {}
+    orjson = sys.modules.get("orjson")
+    if not fast_json:
+        # Makes the decoder code fall back to json
+        sys.modules["orjson"] = None  # type: ignore
+    try:
+        exec(EVENT_STORE_RECORD_DECODER_CODE, namespace)
+    finally:
+        if orjson is None:
+            sys.modules.pop("orjson", None)
+        else:
+            sys.modules["orjson"] = orjson
+    return namespace["decode_message"]
+
+
+def load_type_deserializer_decoder() -> typing.Callable[[dict], typing.Any]:
+    import boto3.dynamodb.types
+
+    deserializer = boto3.dynamodb.types.TypeDeserializer()
+
+    class JsonEncoder(json.JSONEncoder):
+        def default(self, o):
+            if isinstance(o, decimal.Decimal):
+                return float(o)
+            return super().default(o)
+
+    def decode_message(new_image):
+        message = {
+            name: deserializer.deserialize(value)
+            for name, value in new_image.items()
+        }
+        return message, json.dumps(
+            {"type": "EVENT", "message": message}, cls=JsonEncoder
+        )
+
+    return decode_message
+
+
+def run(
+    decode_message: typing.Callable[[dict], typing.Any],
+    images: typing.Sequence[dict],
+    repeat: int,
+) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for image in images:
+            decode_message(image)
+        best = min(best, time.perf_counter() - start)
+    return best / len(images)
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=1000)
+    parser.add_argument(
+        "--fields", type=int, default=20, help="top level fields per event"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    images = [make_new_image(args.fields) for _ in range(args.records)]
+    size = sum(len(json.dumps(i)) for i in images) / len(images)
+
+    decoders = {}
+    try:
+        decoders[
+            "TypeDeserializer + JsonEncoder"
+        ] = load_type_deserializer_decoder()
+    except ImportError:
+        print("boto3 is not installed, skipping TypeDeserializer")
+    decoders["decoder + json"] = load_decoder(fast_json=False)
+    try:
+        import orjson  # noqa: F401
+
+        decoders["decoder + orjson"] = load_decoder(fast_json=True)
+    except ImportError:
+        print("orjson is not installed, skipping decoder + orjson")
+
+    print(
+        f"{args.records} records, {size / 1024:.1f} KiB of attribute "
+        f"value JSON per record, best of {args.repeat}"
+    )
+    baseline = None
+    for name, decode_message in decoders.items():
+        per_record = run(decode_message, images, args.repeat)
+        baseline = baseline or per_record
+        print(
+            f"{name:<32} {per_record * 10**6:>10.1f} us/record"
+            f" {baseline / per_record:>6.1f}x"
+        )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
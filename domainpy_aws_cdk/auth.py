@@ -1,9 +1,13 @@
+import typing
+
 import constructs
 import aws_cdk as cdk
 import aws_cdk.aws_iam as cdk_iam
 import aws_cdk.aws_lambda as cdk_lambda
 import aws_cdk.aws_cognito as cdk_cognito
 
+from .constructs.aws_lambda import resolve_architecture
+
 
 class ClientPool(constructs.Construct):
     def __init__(
@@ -12,15 +16,19 @@ class ClientPool(constructs.Construct):
         id: str,
         *,
         token_len: int = 4,
-        max_attemps: int = 3
+        max_attemps: int = 3,
+        architecture: typing.Optional[cdk_lambda.Architecture] = None,
     ) -> None:
         super().__init__(scope, id)
 
+        architecture = resolve_architecture(self, architecture)
+
         pre_signup_function = cdk_lambda.Function(
             self,
             "pre_signup_function",
             code=cdk_lambda.AssetCode.from_inline(PRE_SIGNUP_CODE),
             runtime=cdk_lambda.Runtime.PYTHON_3_8,
+            architecture=architecture,
             handler="index.handler",
         )
 
@@ -29,6 +37,7 @@ class ClientPool(constructs.Construct):
             "define_auth_challenge_function",
             code=cdk_lambda.AssetCode.from_inline(DEFINE_AUTH_CHALLENGE),
             runtime=cdk_lambda.Runtime.PYTHON_3_8,
+            architecture=architecture,
             handler="index.handler",
             environment={"MAX_ATTEMPTS": str(max_attemps)},
         )
@@ -38,6 +47,7 @@ class ClientPool(constructs.Construct):
             "create_auth_challenge_function",
             code=cdk_lambda.AssetCode.from_inline(CREATE_AUTH_CHALLENGE_CODE),
             runtime=cdk_lambda.Runtime.PYTHON_3_8,
+            architecture=architecture,
             handler="index.handler",
             initial_policy=[
                 cdk_iam.PolicyStatement(
@@ -53,6 +63,7 @@ class ClientPool(constructs.Construct):
             "verify_auth_challenge_function",
             code=cdk_lambda.AssetCode.from_inline(VERIFY_AUTH_CHALLENGE_CODE),
             runtime=cdk_lambda.Runtime.PYTHON_3_8,
+            architecture=architecture,
             handler="index.handler",
         )
 
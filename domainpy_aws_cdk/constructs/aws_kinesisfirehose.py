@@ -7,12 +7,18 @@ import aws_cdk.aws_iam as cdk_iam
 import aws_cdk.aws_lambda as cdk_lambda
 import aws_cdk.aws_kinesisfirehose as cdk_kfirehose
 
+from .aws_lambda import resolve_architecture
 from ..utils import make_unique_resource_name
 
 
 class S3DeliveryStream(cdk.Resource):
     def __init__(
-        self, scope: constructs.Construct, id: str, *, bucket: cdk_s3.Bucket
+        self,
+        scope: constructs.Construct,
+        id: str,
+        *,
+        bucket: cdk_s3.Bucket,
+        architecture: typing.Optional[cdk_lambda.Architecture] = None,
     ) -> None:
         super().__init__(scope, id)
 
@@ -28,6 +34,7 @@ class S3DeliveryStream(cdk.Resource):
             "transformer",
             code=cdk_lambda.Code.from_inline(TRANSFORMER_CODE),
             runtime=cdk_lambda.Runtime.PYTHON_3_8,
+            architecture=resolve_architecture(self, architecture),
             handler="index.handler",
             timeout=cdk.Duration.seconds(30),
             description="[DamTransformer] Adds new line at the end of each event",
@@ -71,7 +78,7 @@ class S3DeliveryStream(cdk.Resource):
         self, grantee: cdk_iam.IGrantable, *actions: str
     ) -> cdk_iam.Grant:
         return cdk_iam.Grant.add_to_principal(
-            actions=actions,
+            actions=list(actions),
             grantee=grantee,
             resource_arns=[self.delivery_stream_arn],
         )
@@ -1,14 +1,74 @@
+from __future__ import annotations
+
 import os
+import re
+import sys
+import time
+import stat
 import uuid
 import shutil
+import zipfile
+import compileall
+import py_compile
+import fnmatch
+import hashlib
 import tempfile
 import typing
-import glob
+import threading
+import subprocess
+import concurrent.futures
 
+import jsii
+import constructs
+import aws_cdk as cdk
+import aws_cdk.aws_s3 as cdk_s3
 import aws_cdk.aws_lambda as cdk_lambda
+import aws_cdk.aws_s3_assets as cdk_s3_assets
+import aws_cdk.aws_ecr_assets as cdk_ecr_assets
 import docker
 
 
+# App wide architecture of the functions, "x86_64" or "arm64", e.g.
+# cdk.json {"context": {"domainpy_aws_cdk:architecture": "arm64"}}
+ARCHITECTURE_CONTEXT_KEY = "domainpy_aws_cdk:architecture"
+
+
+def resolve_architecture(
+    scope: constructs.Construct,
+    architecture: typing.Optional[cdk_lambda.Architecture] = None,
+) -> cdk_lambda.Architecture:
+    """Returns architecture when given, otherwise the app wide one, x86_64
+    unless set in the context."""
+    if architecture is not None:
+        return architecture
+
+    name = scope.node.try_get_context(ARCHITECTURE_CONTEXT_KEY)
+    if name is None or name == cdk_lambda.Architecture.X86_64.name:
+        return cdk_lambda.Architecture.X86_64
+    if name == cdk_lambda.Architecture.ARM_64.name:
+        return cdk_lambda.Architecture.ARM_64
+
+    raise Exception(
+        f"Unknown architecture {name}, expected "
+        f"{cdk_lambda.Architecture.X86_64.name} or "
+        f"{cdk_lambda.Architecture.ARM_64.name}"
+    )
+
+
+def check_architecture(
+    code: typing.Any, architecture: cdk_lambda.Architecture
+) -> None:
+    """Raises when code was packaged by PackageAssetCode for another
+    architecture than the function's."""
+    packaged = getattr(code, "packaged_architecture", None)
+    if packaged is not None and packaged != architecture.name:
+        raise Exception(
+            f"Code packaged for {packaged} can't run on an "
+            f"{architecture.name} function, package it with scope= (to "
+            f"use the app wide architecture) or architecture="
+        )
+
+
 class PackageAssetCode:
     PYTHON_EXCLUDES = [
         "boto3",
@@ -21,36 +81,889 @@ class PackageAssetCode:
         "__pycache__",
     ]
 
+    # Removed from packages by the optimization pass, along with the
+    # *.dist-info files and directories that don't match DIST_INFO_KEEP;
+    # licenses are redistributed along with the packages, so they are kept
+    OPTIMIZE_EXCLUDES = [
+        "tests",
+        "test",
+        "docs",
+        "doc",
+        "examples",
+        "*.pyi",
+        "*.pyx",
+        "*.pxd",
+        "*.c",
+        "*.h",
+        "*.cpp",
+    ]
+    DIST_INFO_KEEP = [
+        "METADATA",
+        "entry_points.txt",
+        "top_level.txt",
+        "LICENSE*",
+        "LICENCE*",
+        "NOTICE*",
+        "COPYING*",
+        "licenses",
+    ]
+
+    CACHE_PATH = os.getenv(
+        "DOMAINPY_AWS_CDK_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "domainpy_aws_cdk"),
+    )
+    CACHE_MAX_SIZE = 2 * 1024**3  # bytes
+
+    # Host directory mounted as pip's cache, so downloaded and built
+    # wheels are reused between builds
+    PIP_CACHE_PATH: typing.Optional[str] = os.path.join(CACHE_PATH, "pip")
+
+    # Directory of prebuilt wheels; when set, dependencies are installed
+    # from it only, without reaching the package index
+    WHEELHOUSE_PATH: typing.Optional[str] = os.getenv(
+        "DOMAINPY_AWS_CDK_WHEELHOUSE"
+    )
+
+    # How dependencies are installed: "docker" runs pip inside docker_image,
+    # "host" installs manylinux wheels with the local pip and only falls
+    # back to docker for requirements that need compiling
+    BACKEND = "docker"
+    HOST_PLATFORM = "manylinux2014_x86_64"
+    HOST_PLATFORM_ARM64 = "manylinux2014_aarch64"
+
+    # Build images used unless docker_image is given, lambci images are
+    # only published for x86_64
+    DOCKER_IMAGE = "lambci/lambda:build-python3.8"
+    DOCKER_IMAGE_ARM64 = "public.ecr.aws/sam/build-python3.8:latest-arm64"
+
+    # Package assets in the background on a pool of PARALLEL_WORKERS
+    # builds; they are awaited right before synthesis
+    PARALLEL = False
+    PARALLEL_WORKERS = os.cpu_count() or 1
+
     @property
     def is_inline(self) -> bool:
         return False
 
     @classmethod
     def from_python_asset(
-        cls, path: str, docker_image: str = "lambci/lambda:build-python3.8"
-    ) -> cdk_lambda.AssetCode:
-        dist = os.path.join(".", "cdk.out", f"package.{uuid.uuid4().hex}.zip")
-
-        _package_python_asset(path, dist, docker_image)
-
-        return cdk_lambda.AssetCode(dist)
+        cls,
+        path: str,
+        docker_image: typing.Optional[str] = None,
+        *,
+        use_cache: bool = True,
+        reproducible: bool = True,
+        backend: typing.Optional[str] = None,
+        optimize: bool = False,
+        strip_sources: bool = False,
+        architecture: typing.Optional[cdk_lambda.Architecture] = None,
+        scope: typing.Optional[constructs.Construct] = None,
+    ) -> cdk_lambda.Code:
+        """Packages the application under path with its requirements
+        built for architecture. Unless given, it is the app wide one when
+        scope is given, x86_64 otherwise."""
+        architecture = cls._architecture(scope, architecture)
+        return cls._package(
+            path,
+            docker_image=cls._docker_image(docker_image, architecture),
+            architecture=architecture.name,
+            use_cache=use_cache,
+            reproducible=reproducible,
+            backend=backend or cls.BACKEND,
+            optimize=optimize,
+            strip_sources=strip_sources,
+        )
 
     @classmethod
     def from_python_inline(
         cls,
         source: str,
         requirements: typing.Sequence[str] = [],
-        docker_image: str = "lambci/lambda:build-python3.8",
-    ) -> cdk_lambda.AssetCode:
-        with tempfile.TemporaryDirectory() as workpath:
+        docker_image: typing.Optional[str] = None,
+        *,
+        use_cache: bool = True,
+        reproducible: bool = True,
+        backend: typing.Optional[str] = None,
+        optimize: bool = False,
+        strip_sources: bool = False,
+        architecture: typing.Optional[cdk_lambda.Architecture] = None,
+        scope: typing.Optional[constructs.Construct] = None,
+    ) -> cdk_lambda.Code:
+        """Packages source as index.py with its requirements. When scope is
+        given, the requirements are installed in a python_layer instead,
+        shared by the functions of the stack with the same requirements,
+        and the package only holds index.py."""
+        architecture = cls._architecture(scope, architecture)
+
+        layers = []
+        if scope is not None and any(r.strip() for r in requirements):
+            layers.append(
+                cls.python_layer(
+                    scope,
+                    requirements,
+                    docker_image,
+                    use_cache=use_cache,
+                    reproducible=reproducible,
+                    backend=backend,
+                    optimize=optimize,
+                    strip_sources=strip_sources,
+                    architecture=architecture,
+                )
+            )
+            requirements = []
+
+        workpath = tempfile.mkdtemp()
+
+        with open(os.path.join(workpath, "requirements.txt"), "w") as file:
+            for requirement in requirements:
+                file.write(f"{requirement}\n")
+
+        with open(os.path.join(workpath, "index.py"), "w") as file:
+            file.write(source)
+
+        code = cls._package(
+            workpath,
+            cleanup=True,
+            docker_image=cls._docker_image(docker_image, architecture),
+            architecture=architecture.name,
+            use_cache=use_cache,
+            reproducible=reproducible,
+            backend=backend or cls.BACKEND,
+            optimize=optimize,
+            strip_sources=strip_sources,
+        )
+        if not layers:
+            return code
+
+        layered = _LayeredCode(code, layers)
+        # Read by check_architecture
+        setattr(layered, "packaged_architecture", architecture.name)
+        return layered
+
+    @classmethod
+    def from_python_image(
+        cls,
+        path: str,
+        base_image: str = "public.ecr.aws/lambda/python:3.8",
+        *,
+        system_packages: typing.Sequence[str] = [],
+    ) -> PythonImageCode:
+        """Packages the application under path as a container image.
+
+        The image is built in layers for the operating system packages, the
+        requirements and the application code, so changes to the code only
+        rebuild the last layer.
+        """
+        key = _hash_python_asset(
+            path, cls.PYTHON_EXCLUDES, base_image, *system_packages
+        )
+        directory = os.path.join(".", "cdk.out", f"image.{key}")
+
+        if not os.path.isdir(directory):
+            staging = f"{directory}.{uuid.uuid4().hex}.partial"
+            _stage_tree(path, staging, _compile_excludes(cls.PYTHON_EXCLUDES))
+
+            requirements = os.path.join(staging, "requirements.txt")
+            if not os.path.isfile(requirements):
+                open(requirements, "w").close()
+
+            with open(os.path.join(staging, "Dockerfile"), "w") as file:
+                file.write(_python_dockerfile(base_image, system_packages))
+
+            with open(os.path.join(staging, ".dockerignore"), "w") as file:
+                file.write("Dockerfile\n.dockerignore\n")
+
+            try:
+                os.rename(staging, directory)
+            except OSError:
+                # Staged concurrently by another build
+                shutil.rmtree(staging, ignore_errors=True)
+
+        return PythonImageCode(directory)
+
+    @classmethod
+    def python_layer(
+        cls,
+        scope: constructs.Construct,
+        requirements: typing.Sequence[str],
+        docker_image: typing.Optional[str] = None,
+        *,
+        compatible_runtimes: typing.Optional[
+            typing.Sequence[cdk_lambda.Runtime]
+        ] = None,
+        use_cache: bool = True,
+        reproducible: bool = True,
+        backend: typing.Optional[str] = None,
+        optimize: bool = False,
+        strip_sources: bool = False,
+        architecture: typing.Optional[cdk_lambda.Architecture] = None,
+    ) -> cdk_lambda.LayerVersion:
+        """Returns a layer with the requirements installed under python/.
+
+        Layers are created once per stack, requirement set and
+        architecture, functions sharing the same requirements share the
+        same layer, so that their own packages only hold application code.
+        """
+        architecture = resolve_architecture(scope, architecture)
+        docker_image = cls._docker_image(docker_image, architecture)
+
+        requirements = sorted({r.strip() for r in requirements if r.strip()})
+        key = hashlib.sha256(
+            "\0".join(
+                [
+                    docker_image,
+                    f"architecture={architecture.name}",
+                    f"optimize={optimize}",
+                    f"strip_sources={strip_sources}",
+                    *requirements,
+                ]
+            ).encode("utf-8")
+        ).hexdigest()
+
+        stack = cdk.Stack.of(scope)
+        id = f"PythonLayer{key[:8].upper()}"
+
+        layer = stack.node.try_find_child(id)
+        if layer is None:
+            workpath = tempfile.mkdtemp()
             with open(os.path.join(workpath, "requirements.txt"), "w") as file:
                 for requirement in requirements:
                     file.write(f"{requirement}\n")
 
-            with open(os.path.join(workpath, "index.py"), "w") as file:
-                file.write(source)
+            layer = cdk_lambda.LayerVersion(
+                stack,
+                id,
+                code=cls._package(
+                    workpath,
+                    cleanup=True,
+                    prefix="python",
+                    docker_image=docker_image,
+                    architecture=architecture.name,
+                    use_cache=use_cache,
+                    reproducible=reproducible,
+                    backend=backend or cls.BACKEND,
+                    optimize=optimize,
+                    strip_sources=strip_sources,
+                ),
+                compatible_runtimes=compatible_runtimes,
+                compatible_architectures=[architecture],
+                description=f"[PackageAssetCode] {', '.join(requirements)}",
+            )
+
+        return typing.cast(cdk_lambda.LayerVersion, layer)
+
+    @classmethod
+    def _architecture(
+        cls,
+        scope: typing.Optional[constructs.Construct],
+        architecture: typing.Optional[cdk_lambda.Architecture],
+    ) -> cdk_lambda.Architecture:
+        if scope is not None:
+            return resolve_architecture(scope, architecture)
+        return architecture or cdk_lambda.Architecture.X86_64
+
+    @classmethod
+    def _docker_image(
+        cls,
+        docker_image: typing.Optional[str],
+        architecture: cdk_lambda.Architecture,
+    ) -> str:
+        if docker_image is not None:
+            return docker_image
+        if architecture.name == cdk_lambda.Architecture.ARM_64.name:
+            return cls.DOCKER_IMAGE_ARM64
+        return cls.DOCKER_IMAGE
+
+    @classmethod
+    def _package(
+        cls,
+        path: str,
+        *,
+        cleanup: bool = False,
+        architecture: str,
+        **options: typing.Any,
+    ) -> cdk_lambda.Code:
+        # Resolved here, builds may run on packager threads which must not
+        # call into jsii
+        if architecture == "arm64":
+            host_platform = cls.HOST_PLATFORM_ARM64
+            docker_platform = "linux/arm64"
+        else:
+            host_platform = cls.HOST_PLATFORM
+            docker_platform = "linux/amd64"
+
+        def build() -> str:
+            try:
+                return cls._build(
+                    path,
+                    architecture=architecture,
+                    host_platform=host_platform,
+                    docker_platform=docker_platform,
+                    **options,
+                )
+            finally:
+                if cleanup:
+                    shutil.rmtree(path, ignore_errors=True)
+
+        code: cdk_lambda.Code
+        if cls.PARALLEL:
+            packager = ParallelPackager.instance(cls.PARALLEL_WORKERS)
+            code = DeferredAssetCode(packager.submit(build), packager)
+        else:
+            code = cdk_lambda.AssetCode(build())
+
+        # Read by check_architecture
+        setattr(code, "packaged_architecture", architecture)
+        return code
+
+    @classmethod
+    def _build(
+        cls,
+        path: str,
+        *,
+        docker_image: str,
+        architecture: str,
+        host_platform: str,
+        docker_platform: str,
+        use_cache: bool,
+        reproducible: bool,
+        backend: str,
+        optimize: bool,
+        strip_sources: bool,
+        prefix: str = "",
+    ) -> str:
+        cache = PackageCache(cls.CACHE_PATH, max_size=cls.CACHE_MAX_SIZE)
+        key = _hash_python_asset(
+            path,
+            cls.PYTHON_EXCLUDES,
+            docker_image,
+            f"architecture={architecture}",
+            f"reproducible={reproducible}",
+            f"offline={cls.WHEELHOUSE_PATH is not None}",
+            f"backend={backend}",
+            f"prefix={prefix}",
+            f"optimize={optimize}",
+            f"strip_sources={strip_sources}",
+        )
+
+        with tempfile.TemporaryDirectory() as work_path:
+            package = os.path.join(work_path, "package.zip")
+            if not (use_cache and cache.get(key, package)):
+                _package_python_asset(
+                    path,
+                    package,
+                    docker_image,
+                    reproducible=reproducible,
+                    pip_cache=cls.PIP_CACHE_PATH,
+                    wheelhouse=cls.WHEELHOUSE_PATH,
+                    backend=backend,
+                    host_platform=host_platform,
+                    docker_platform=docker_platform,
+                    prefix=prefix,
+                    optimize=optimize,
+                    strip_sources=strip_sources,
+                    cache=cache if use_cache else None,
+                )
+                if use_cache:
+                    cache.put(key, package)
+
+            # A name derived from the content keeps the output stable
+            # between synths when the package didn't change
+            if reproducible:
+                name = _hash_file(package)
+            else:
+                name = uuid.uuid4().hex
+
+            dist = os.path.join(".", "cdk.out", f"package.{name}.zip")
+            # Concurrent builds of the same asset write the same name, so
+            # the package is moved into place once complete
+            partial = f"{dist}.{uuid.uuid4().hex}.partial"
+            shutil.copyfile(package, partial)
+            os.replace(partial, dist)
+
+        return dist
+
+
+class PythonImageCode:
+    """Container image of a Python application.
+
+    The same image serves several handlers, each function overrides the
+    image command with its handler.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def for_handler(
+        self,
+        handler: str,
+        *,
+        architecture: typing.Optional[cdk_lambda.Architecture] = None,
+    ) -> cdk_lambda.DockerImageCode:
+        return cdk_lambda.DockerImageCode.from_image_asset(
+            self.directory,
+            cmd=[handler],
+            platform=cdk_ecr_assets.Platform.custom(
+                (
+                    architecture or cdk_lambda.Architecture.X86_64
+                ).docker_platform
+            ),
+        )
+
+
+class ParallelPackager:
+    """Runs package builds on a bounded pool of workers and keeps track of
+    the time saved compared to building them one after another.
+    """
+
+    _instance: typing.Optional[ParallelPackager] = None
+
+    def __init__(self, max_workers: int) -> None:
+        self.max_workers = max_workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="package"
+        )
+        self.lock = threading.Lock()
+        self.futures: typing.List[concurrent.futures.Future] = []
+        self.durations: typing.List[float] = []
+        self.started_at: typing.Optional[float] = None
+        self.finished_at: typing.Optional[float] = None
+
+    @classmethod
+    def instance(cls, max_workers: int) -> ParallelPackager:
+        if cls._instance is None or cls._instance.max_workers != max_workers:
+            cls._instance = ParallelPackager(max_workers)
+        return cls._instance
+
+    def submit(
+        self, build: typing.Callable[[], str]
+    ) -> concurrent.futures.Future:
+        def run() -> str:
+            start = time.perf_counter()
+            try:
+                return build()
+            finally:
+                end = time.perf_counter()
+                with self.lock:
+                    self.durations.append(end - start)
+                    self.finished_at = max(self.finished_at or end, end)
+
+        with self.lock:
+            if self.started_at is None:
+                self.started_at = time.perf_counter()
+            future = self.executor.submit(run)
+            self.futures.append(future)
+
+        return future
+
+    def report(self) -> None:
+        with self.lock:
+            if not self.futures or not all(f.done() for f in self.futures):
+                return
+
+            wall_time = (self.finished_at or 0) - (self.started_at or 0)
+            sequential_time = sum(self.durations)
+            print(
+                f"Packaged {len(self.futures)} assets in {wall_time:.1f}s "
+                f"with {self.max_workers} workers "
+                f"({sequential_time:.1f}s sequentially, "
+                f"{max(sequential_time - wall_time, 0):.1f}s saved)"
+            )
+
+            self.futures = []
+            self.durations = []
+            self.started_at = None
+            self.finished_at = None
+
+
+class DeferredAssetCode(cdk_lambda.Code):
+    """Lambda code which package is being built by a ParallelPackager.
+
+    The S3 location is resolved lazily; the asset itself is staged by an
+    aspect once the build completes, before the app is synthesized.
+    """
+
+    def __init__(
+        self, future: concurrent.futures.Future, packager: ParallelPackager
+    ) -> None:
+        super().__init__()
+        self.future = future
+        self.packager = packager
+        self.asset: typing.Optional[cdk_s3_assets.Asset] = None
+        self.scope: typing.Optional[constructs.Construct] = None
+        self.resources: typing.List[typing.Tuple[cdk.CfnResource, str]] = []
+
+    def bind(self, scope: constructs.Construct) -> cdk_lambda.CodeConfig:
+        # If the same code is used multiple times, retain the first scope
+        if self.scope is None:
+            self.scope = scope
+            cdk.Aspects.of(scope).add(_StageDeferredAssetCode(self))
+        elif cdk.Stack.of(self.scope) != cdk.Stack.of(scope):
+            raise Exception(
+                f"Asset is already associated with another stack "
+                f"'{cdk.Stack.of(self.scope).stack_name}'. "
+                "Create a new Code instance for every stack."
+            )
+
+        return cdk_lambda.CodeConfig(
+            s3_location=cdk_s3.Location(
+                bucket_name=cdk.Lazy.string(
+                    _Producer(lambda: self._staged().s3_bucket_name)
+                ),
+                object_key=cdk.Lazy.string(
+                    _Producer(lambda: self._staged().s3_object_key)
+                ),
+            )
+        )
+
+    def bind_to_resource(
+        self,
+        resource: cdk.CfnResource,
+        *,
+        resource_property: typing.Optional[str] = None,
+    ) -> None:
+        self.resources.append((resource, resource_property or "Code"))
+
+    def stage(self) -> None:
+        if self.asset is not None or self.scope is None:
+            return
+
+        self.asset = cdk_s3_assets.Asset(
+            self.scope, "Code", path=self.future.result()
+        )
+        for resource, resource_property in self.resources:
+            self.asset.add_resource_metadata(resource, resource_property)
+
+        self.packager.report()
+
+    def _staged(self) -> cdk_s3_assets.Asset:
+        if self.asset is None:
+            raise Exception("Asset has not been staged before synthesis")
+        return self.asset
+
+
+class _LayeredCode(cdk_lambda.Code):
+    """Lambda code which requirements are installed in layers, attached to
+    every function the code is bound to."""
+
+    def __init__(
+        self,
+        code: cdk_lambda.Code,
+        layers: typing.Sequence[cdk_lambda.ILayerVersion],
+    ) -> None:
+        super().__init__()
+        self.code = code
+        self.layers = layers
+
+    def bind(self, scope: constructs.Construct) -> cdk_lambda.CodeConfig:
+        if not isinstance(scope, cdk_lambda.Function):
+            raise Exception(
+                "Code with requirements packaged in a layer can only be "
+                "used by functions"
+            )
+
+        scope.add_layers(*self.layers)
+        return self.code.bind(scope)
+
+    def bind_to_resource(
+        self,
+        resource: cdk.CfnResource,
+        *,
+        resource_property: typing.Optional[str] = None,
+    ) -> None:
+        self.code.bind_to_resource(
+            resource, resource_property=resource_property
+        )
+
+
+@jsii.implements(cdk.IAspect)
+class _StageDeferredAssetCode:
+    def __init__(self, code: DeferredAssetCode) -> None:
+        self.code = code
+
+    def visit(self, node: constructs.IConstruct) -> None:
+        # Nodes are compared by path, jsii doesn't preserve proxies identity
+        scope = self.code.scope
+        if scope is not None and node.node.path == scope.node.path:
+            self.code.stage()
+
+
+@jsii.implements(cdk.IStableStringProducer)
+class _Producer:
+    def __init__(self, produce: typing.Callable[[], str]) -> None:
+        self._produce = produce
+
+    def produce(self) -> typing.Optional[str]:
+        return self._produce()
+
+
+class PackageCache:
+    """Persistent store of packaged zips keyed by a content hash.
+
+    Entries are evicted in least recently used order once the total size
+    of the store goes beyond ``max_size`` bytes. Entries are copied in and
+    out of the store, under a lock shared by the builds of the process, so
+    that eviction never removes an entry while it is read.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, path: str, *, max_size: int) -> None:
+        self.path = path
+        self.max_size = max_size
+
+    def get(self, key: str, destination: str) -> bool:
+        """Copies the entry of key to destination, returns whether there
+        was one."""
+        filename = self._filename(key)
+        with self._lock:
+            try:
+                # Touch the entry so that it becomes the most recently used
+                os.utime(filename)
+                shutil.copyfile(filename, destination)
+            except FileNotFoundError:
+                return False
+        return True
+
+    def put(self, key: str, source: str) -> None:
+        os.makedirs(self.path, exist_ok=True)
+
+        filename = self._filename(key)
+        partial = f"{filename}.{uuid.uuid4().hex}.partial"
+        shutil.copyfile(source, partial)
+
+        with self._lock:
+            os.replace(partial, filename)
+            # Even when it alone goes beyond max_size
+            self.evict(keep=key)
+
+    def evict(self, *, keep: typing.Optional[str] = None) -> None:
+        kept = os.path.basename(self._filename(keep)) if keep else None
+
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".zip"):
+                continue
+
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if name == kept:
+                continue
+
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def _filename(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.zip")
+
 
-            return cls.from_python_asset(workpath, docker_image=docker_image)
+def _hash_python_asset(
+    path: str, excludes: typing.Sequence[str], *parameters: str
+) -> str:
+    digest = hashlib.sha256()
+    for parameter in parameters:
+        digest.update(b"\0parameter\0" + parameter.encode("utf-8"))
+    for exclude in excludes:
+        digest.update(b"\0exclude\0" + exclude.encode("utf-8"))
+
+    # Walks the same tree the package is built from: excluded paths are
+    # left out (e.g. a local virtualenv) and symlinked directories are
+    # followed, so editing a linked file changes the key
+    for arcname, filepath in _walk_tree(path, _compile_excludes(excludes)):
+        digest.update(b"\0file\0" + arcname.encode("utf-8") + b"\0")
+        digest.update(_hash_file(filepath).encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _hash_requirements(
+    requirements: str, source_path: str, matcher: typing.Pattern[str]
+) -> str:
+    """Hashes a requirements file along with the files it references:
+    nested requirement and constraint files, and local projects, which
+    resolve against the source tree like they do when installing.
+    """
+    digest = hashlib.sha256()
+
+    pending = [os.path.abspath(requirements)]
+    seen = set()
+    while pending:
+        path = pending.pop(0)
+        if path in seen:
+            continue
+        seen.add(path)
+
+        name = os.path.relpath(path, source_path)
+        digest.update(b"\0requirements\0" + name.encode("utf-8") + b"\0")
+        digest.update(_hash_file(path).encode("utf-8"))
+
+        for reference, local in _requirement_references(path):
+            if not local:
+                pending.append(os.path.join(os.path.dirname(path), reference))
+                continue
+
+            project = os.path.join(source_path, reference)
+            if os.path.isfile(project):
+                digest.update(b"\0project\0" + reference.encode("utf-8"))
+                digest.update(_hash_file(project).encode("utf-8"))
+            elif os.path.isdir(project):
+                digest.update(b"\0project\0" + reference.encode("utf-8"))
+                for arcname, filepath in _walk_tree(project, matcher):
+                    digest.update(b"\0file\0" + arcname.encode("utf-8"))
+                    digest.update(_hash_file(filepath).encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def _requirement_references(
+    path: str,
+) -> typing.List[typing.Tuple[str, bool]]:
+    """Returns the (path, local) of the files referenced by a requirements
+    file: nested requirement and constraint files (relative to the file),
+    and local projects (relative to the working directory).
+    """
+    references = []
+
+    with open(path) as file:
+        for line in file:
+            line = re.sub(r"(^|\s)#.*", "", line).strip()
+            if not line:
+                continue
+
+            match = re.match(
+                r"(--requirement|--constraint|--editable|-r|-c|-e)[\s=]*(\S+)",
+                line,
+            )
+            if match is not None:
+                option, reference = match.groups()
+                if option in ("--editable", "-e"):
+                    reference = _local_project(reference) or ""
+                    if reference:
+                        references.append((reference, True))
+                else:
+                    references.append((reference, False))
+            elif not line.startswith("-"):
+                reference = _local_project(line.split(";")[0].strip())
+                if reference:
+                    references.append((reference, True))
+
+    return references
+
+
+def _local_project(requirement: str) -> typing.Optional[str]:
+    """Returns the path of a requirement on a local project, e.g. ./lib,
+    file:lib or name @ file:///path/to/lib."""
+    if " @ " in requirement:
+        requirement = requirement.split(" @ ", 1)[1].strip()
+    if requirement.startswith("file:"):
+        return re.sub(r"^file:(//)?", "", requirement).split("#")[0]
+    if requirement.startswith((".", "/")):
+        return requirement.split("#")[0]
+    return None
+
+
+def _stage_tree(
+    path: str, target_path: str, matcher: typing.Pattern[str]
+) -> None:
+    """Copies the files under path that are not excluded to target_path."""
+    for arcname, filepath in _walk_tree(path, matcher):
+        target = os.path.join(target_path, *arcname.split("/"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(filepath, target)
+
+
+def _compile_excludes(excludes: typing.Sequence[str]) -> typing.Pattern[str]:
+    """Compiles glob patterns matched against file and directory names
+    into a single regular expression."""
+    if not excludes:
+        return re.compile(r"(?!)")  # never matches
+
+    return re.compile(
+        "|".join(f"(?:{fnmatch.translate(e)})" for e in excludes)
+    )
+
+
+def _walk_tree(
+    root: str, excludes: typing.Pattern[str], prefix: str = ""
+) -> typing.List[typing.Tuple[str, str]]:
+    """Returns the (arcname, filepath) of the files under root, sorted by
+    arcname, skipping files and directories which name is excluded.
+
+    Symlinked directories are followed, unless they link back to one of
+    their parents.
+    """
+    entries = []
+
+    # Real paths of each directory and its parents, to break link cycles
+    parents: typing.Dict[str, typing.Tuple[str, ...]] = {
+        root: (os.path.realpath(root),)
+    }
+
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        realpaths = parents.pop(dirpath)
+
+        kept = []
+        for dirname in dirnames:
+            if excludes.match(dirname):
+                continue
+
+            subpath = os.path.join(dirpath, dirname)
+            realpath = os.path.realpath(subpath)
+            if realpath in realpaths:
+                continue
+
+            parents[subpath] = realpaths + (realpath,)
+            kept.append(dirname)
+        dirnames[:] = kept
+
+        relpath = os.path.relpath(dirpath, root)
+        parts = [prefix] if prefix else []
+        if relpath != ".":
+            parts += relpath.split(os.sep)
+
+        for filename in filenames:
+            if not excludes.match(filename):
+                entries.append(
+                    (
+                        "/".join(parts + [filename]),
+                        os.path.join(dirpath, filename),
+                    )
+                )
+
+    return sorted(entries, key=lambda e: e[0].split("/"))
+
+
+def _remove_excluded(root: str, excludes: typing.Pattern[str]) -> None:
+    for dirpath, dirnames, filenames in os.walk(root):
+        for dirname in [d for d in dirnames if excludes.match(d)]:
+            shutil.rmtree(os.path.join(dirpath, dirname), ignore_errors=True)
+            dirnames.remove(dirname)
+
+        for filename in filenames:
+            if excludes.match(filename):
+                try:
+                    os.remove(os.path.join(dirpath, filename))
+                except OSError:
+                    print(f"Couldn't remove {filename} from build")
 
 
 def _package_python_asset(
@@ -58,47 +971,541 @@ def _package_python_asset(
     output: str,
     docker_image: str,
     excludes: typing.Sequence[str] = PackageAssetCode.PYTHON_EXCLUDES,
+    *,
+    reproducible: bool = True,
+    pip_cache: typing.Optional[str] = None,
+    wheelhouse: typing.Optional[str] = None,
+    backend: str = "docker",
+    host_platform: str = PackageAssetCode.HOST_PLATFORM,
+    docker_platform: typing.Optional[str] = None,
+    prefix: str = "",
+    optimize: bool = False,
+    strip_sources: bool = False,
+    cache: typing.Optional[PackageCache] = None,
 ) -> None:
+    """Packages the application under path along with its requirements.
+
+    The application is streamed from path into the zip. Dependencies are
+    installed into a zip of their own which is kept in the cache, so when
+    only the application changed the package is that zip with the
+    application appended to it.
+    """
+    matcher = _compile_excludes(excludes)
+
     with tempfile.TemporaryDirectory() as work_path:
-        build_path = os.path.join(work_path, "build")
-        dist_path = os.path.join(work_path, "dist")
+        dependencies = None
+
+        requirements = os.path.join(path, "requirements.txt")
+        if _has_requirements(requirements):
+            dependencies = _package_python_dependencies(
+                requirements,
+                path,
+                work_path,
+                docker_image=docker_image,
+                matcher=matcher,
+                reproducible=reproducible,
+                pip_cache=pip_cache,
+                wheelhouse=wheelhouse,
+                backend=backend,
+                host_platform=host_platform,
+                docker_platform=docker_platform,
+                prefix=prefix,
+                optimize=optimize,
+                strip_sources=strip_sources,
+                cache=cache,
+            )
+        # else: nothing to install, e.g. application code whose
+        # dependencies are provided by a layer
+
+        if optimize:
+            # Optimization rewrites the application, so it is staged
+            application_path = os.path.join(work_path, "application")
+            _stage_tree(path, application_path, matcher)
+
+            _optimize_build(
+                application_path,
+                strip_sources=strip_sources,
+                docker_image=docker_image,
+                docker_platform=docker_platform,
+                backend=backend,
+            )
+            # Already filtered, and bytecode must be kept
+            entries = _walk_tree(
+                application_path, _compile_excludes([]), prefix
+            )
+        else:
+            entries = _walk_tree(path, matcher, prefix)
 
-        # print("Preparing working directory...")
-        os.mkdir(dist_path)
+        # print("Packaging application into zip file...")
+        mode: typing.Literal["w", "a"] = "w"
+        if dependencies is not None:
+            _copy_zip(
+                dependencies, output, [arcname for arcname, _ in entries]
+            )
+            mode = "a"
+
+        with zipfile.ZipFile(output, mode) as archive:
+            for arcname, filepath in entries:
+                _write_zip_entry(archive, arcname, filepath, reproducible)
+        # print(f"Application packaged into [{self.output}]")
 
-        # print("Copying application to build path...")
-        shutil.copytree(path, build_path)
 
+def _package_python_dependencies(
+    requirements: str,
+    source_path: str,
+    work_path: str,
+    *,
+    docker_image: str,
+    matcher: typing.Pattern[str],
+    reproducible: bool,
+    pip_cache: typing.Optional[str],
+    wheelhouse: typing.Optional[str],
+    backend: str,
+    host_platform: str,
+    docker_platform: typing.Optional[str],
+    prefix: str,
+    optimize: bool,
+    strip_sources: bool,
+    cache: typing.Optional[PackageCache],
+) -> str:
+    """Returns a zip with the requirements installed.
+
+    Requirements are installed from a copy of the source tree, which is the
+    working directory of pip, so that local projects (e.g. ./lib or -e .)
+    resolve against the application.
+    """
+    key = hashlib.sha256(
+        "\0".join(
+            [
+                _hash_requirements(requirements, source_path, matcher),
+                matcher.pattern,
+                docker_image,
+                f"reproducible={reproducible}",
+                f"offline={wheelhouse is not None}",
+                f"backend={backend}",
+                f"platform={host_platform}",
+                f"docker_platform={docker_platform}",
+                f"prefix={prefix}",
+                f"optimize={optimize}",
+                f"strip_sources={strip_sources}",
+            ]
+        ).encode("utf-8")
+    ).hexdigest()
+
+    output = os.path.join(work_path, "dependencies.zip")
+    if cache is not None and cache.get(f"dependencies.{key}", output):
+        return output
+
+    build_path = os.path.join(work_path, "dependencies")
+    os.mkdir(build_path)
+
+    # A copy, as building local projects writes into their directory
+    staged_path = os.path.join(work_path, "source")
+    _stage_tree(source_path, staged_path, matcher)
+    requirements = os.path.join(
+        staged_path, os.path.relpath(requirements, source_path)
+    )
+
+    if backend == "host":
+        # print("Installing dependencies [running in host]...")
+        failed = _install_requirements_on_host(
+            build_path,
+            requirements,
+            working_path=staged_path,
+            python_version=_python_version(docker_image),
+            platform=host_platform,
+            pip_cache=pip_cache,
+            wheelhouse=wheelhouse,
+        )
+
+        if failed:
+            print(
+                "No binary distribution for "
+                f"{', '.join(failed)}, building in Docker..."
+            )
+            options, _ = _read_requirements(requirements)
+            # Next to the original, so relative references still resolve
+            requirements = os.path.join(
+                os.path.dirname(requirements), "requirements.fallback.txt"
+            )
+            with open(requirements, "w") as file:
+                file.writelines(f"{line}\n" for line in options + failed)
+
+            _install_requirements_in_docker(
+                build_path,
+                requirements,
+                working_path=staged_path,
+                docker_image=docker_image,
+                docker_platform=docker_platform,
+                pip_cache=pip_cache,
+                wheelhouse=wheelhouse,
+            )
+    elif backend == "docker":
         # print("Installing dependencies [running in Docker]...")
+        _install_requirements_in_docker(
+            build_path,
+            requirements,
+            working_path=staged_path,
+            docker_image=docker_image,
+            docker_platform=docker_platform,
+            pip_cache=pip_cache,
+            wheelhouse=wheelhouse,
+        )
+    else:
+        raise Exception(f"Unknown packaging backend: {backend}")
+
+    _remove_excluded(build_path, matcher)
+
+    if optimize:
+        _optimize_build(
+            build_path,
+            strip_sources=strip_sources,
+            docker_image=docker_image,
+            docker_platform=docker_platform,
+            backend=backend,
+        )
+
+    with zipfile.ZipFile(output, "w") as archive:
+        for arcname, filepath in _walk_tree(
+            build_path, _compile_excludes([]), prefix
+        ):
+            _write_zip_entry(archive, arcname, filepath, reproducible)
+
+    if cache is not None:
+        cache.put(f"dependencies.{key}", output)
+    return output
+
+
+def _optimize_build(
+    build_path: str,
+    *,
+    strip_sources: bool,
+    docker_image: str,
+    docker_platform: typing.Optional[str] = None,
+    backend: str,
+) -> None:
+    """Trims the build for faster cold starts: drops files that are not
+    needed at runtime, precompiles bytecode for the target runtime and,
+    optionally, drops the sources that have been compiled.
+    """
+    initial_sizes = _tree_sizes(build_path)
+
+    _remove_excluded(
+        build_path, _compile_excludes(PackageAssetCode.OPTIMIZE_EXCLUDES)
+    )
+
+    keep = _compile_excludes(PackageAssetCode.DIST_INFO_KEEP)
+    for dirpath, dirnames, filenames in os.walk(build_path):
+        if not dirpath.endswith(".dist-info"):
+            continue
+
+        for filename in filenames:
+            if not keep.match(filename):
+                os.remove(os.path.join(dirpath, filename))
+
+        for dirname in dirnames:
+            if not keep.match(dirname):
+                shutil.rmtree(os.path.join(dirpath, dirname))
+        dirnames.clear()
+
+    # Sourceless imports require the bytecode next to the source (legacy
+    # layout); the hash based invalidation keeps bytecode valid regardless
+    # of the timestamps stored in the zip
+    python_version = _python_version(docker_image)
+    if python_version == "{}.{}".format(*sys.version_info[:2]):
+        compileall.compile_dir(
+            build_path,
+            quiet=1,
+            legacy=strip_sources,
+            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+        )
+    elif backend == "docker":
+        legacy = "-b " if strip_sources else ""
         client = docker.from_env()
         client.containers.run(
             image=docker_image,
-            command="/bin/sh -c 'python3 -m pip install --target /var/task/ --requirement /var/task/requirements.txt '",
+            command=f"/bin/sh -c 'python3 -m compileall -q {legacy}--invalidation-mode unchecked-hash /var/task/'",
             remove=True,
             volumes={build_path: {"bind": "/var/task", "mode": "rw"}},
             user=0,
+            platform=docker_platform,
+        )
+    else:
+        print(
+            f"Skipped bytecode compilation: the host runs Python "
+            f"{sys.version_info[0]}.{sys.version_info[1]} and the target "
+            f"runtime is Python {python_version}"
         )
+        strip_sources = False
 
-        for exclude in excludes:
-            pattern = os.path.join(build_path, "**", exclude)
+    if strip_sources:
+        for dirpath, _, filenames in os.walk(build_path):
+            for filename in filenames:
+                if filename.endswith(".py") and f"{filename}c" in filenames:
+                    os.remove(os.path.join(dirpath, filename))
 
-            paths = glob.glob(pattern, recursive=True)
-            for path in paths:
-                try:
-                    if os.path.isdir(path):
-                        shutil.rmtree(path)
-                    if os.path.isfile(path):
-                        os.remove(path)
-                except OSError:
-                    print(f"Couldn't remove {path} from build")
+    _print_size_report(initial_sizes, _tree_sizes(build_path))
 
-        # print("Packaging application into zip file...")
-        zip_filename = shutil.make_archive(
-            base_name=os.path.join(dist_path, "app"),
-            format="zip",
-            root_dir=build_path,
-            verbose=True,
+
+def _tree_sizes(path: str) -> typing.Dict[str, int]:
+    """Returns the size in bytes of each top-level entry under path."""
+    sizes: typing.Dict[str, int] = {}
+
+    for dirpath, _, filenames in os.walk(path):
+        relpath = os.path.relpath(dirpath, path)
+        for filename in filenames:
+            top = relpath.split(os.sep)[0] if relpath != "." else filename
+            size = os.path.getsize(os.path.join(dirpath, filename))
+            sizes[top] = sizes.get(top, 0) + size
+
+    return sizes
+
+
+def _print_size_report(
+    initial_sizes: typing.Mapping[str, int], sizes: typing.Mapping[str, int]
+) -> None:
+    def kib(size: int) -> str:
+        return f"{size / 1024:>10.1f} KiB"
+
+    # Names only found after, e.g. index.pyc once sources are stripped
+    names = set(initial_sizes) | set(sizes)
+
+    print(f"{'Package':<40} {'Before':>14} {'After':>14}")
+    for name in sorted(
+        names,
+        key=lambda n: (initial_sizes.get(n, 0), sizes.get(n, 0), n),
+        reverse=True,
+    ):
+        print(
+            f"{name[:40]:<40} {kib(initial_sizes.get(name, 0))} "
+            f"{kib(sizes.get(name, 0))}"
         )
+    print(
+        f"{'Total':<40} {kib(sum(initial_sizes.values()))} "
+        f"{kib(sum(sizes.values()))}"
+    )
 
-        shutil.move(zip_filename, output)
-        # print(f"Application packaged into [{self.output}]")
+
+def _python_dockerfile(
+    base_image: str, system_packages: typing.Sequence[str]
+) -> str:
+    lines = [f"FROM {base_image}", ""]
+
+    if system_packages:
+        lines += [
+            "# Operating system packages",
+            f"RUN yum install -y {' '.join(system_packages)} && yum clean all",
+            "",
+        ]
+
+    lines += [
+        "# Dependencies, only rebuilt when requirements.txt changes",
+        "COPY requirements.txt ${LAMBDA_TASK_ROOT}/",
+        "RUN python3 -m pip install --no-cache-dir "
+        "--target ${LAMBDA_TASK_ROOT} "
+        "--requirement ${LAMBDA_TASK_ROOT}/requirements.txt",
+        "",
+        "# Application",
+        "COPY . ${LAMBDA_TASK_ROOT}/",
+        "",
+    ]
+
+    return "\n".join(lines)
+
+
+def _install_requirements_in_docker(
+    target_path: str,
+    requirements: str,
+    *,
+    working_path: str,
+    docker_image: str,
+    docker_platform: typing.Optional[str] = None,
+    pip_cache: typing.Optional[str],
+    wheelhouse: typing.Optional[str],
+) -> None:
+    # Requirements are read from the working tree, so that relative
+    # references (e.g. -r base.txt or ./lib) keep working
+    volumes = {
+        target_path: {"bind": "/var/task", "mode": "rw"},
+        os.path.abspath(working_path): {"bind": "/var/source", "mode": "rw"},
+    }
+    requirements = "/".join(
+        os.path.relpath(requirements, working_path).split(os.sep)
+    )
+    environment = {}
+    pip_options = ""
+
+    if pip_cache is not None:
+        os.makedirs(pip_cache, exist_ok=True)
+        volumes[os.path.abspath(pip_cache)] = {
+            "bind": "/var/cache/pip",
+            "mode": "rw",
+        }
+        environment["PIP_CACHE_DIR"] = "/var/cache/pip"
+
+    if wheelhouse is not None:
+        volumes[os.path.abspath(wheelhouse)] = {
+            "bind": "/var/wheelhouse",
+            "mode": "ro",
+        }
+        pip_options += "--no-index --find-links /var/wheelhouse "
+
+    client = docker.from_env()
+    client.containers.run(
+        image=docker_image,
+        command=f"/bin/sh -c 'python3 -m pip install {pip_options}--target /var/task/ --requirement /var/source/{requirements} '",
+        remove=True,
+        volumes=volumes,
+        working_dir="/var/source",
+        environment=environment,
+        user=0,
+        platform=docker_platform,
+    )
+
+
+def _install_requirements_on_host(
+    target_path: str,
+    requirements: str,
+    *,
+    working_path: str,
+    python_version: str,
+    platform: str,
+    pip_cache: typing.Optional[str],
+    wheelhouse: typing.Optional[str],
+) -> typing.List[str]:
+    """Installs binary wheels built for the Lambda platform into
+    target_path and returns the requirements that couldn't be installed that way.
+    """
+    command = [
+        sys.executable,
+        "-m",
+        "pip",
+        "install",
+        "--quiet",
+        "--platform",
+        platform,
+        "--implementation",
+        "cp",
+        "--python-version",
+        python_version,
+        "--only-binary=:all:",
+        "--target",
+        target_path,
+    ]
+    if pip_cache is not None:
+        command += ["--cache-dir", pip_cache]
+    if wheelhouse is not None:
+        command += ["--no-index", "--find-links", wheelhouse]
+
+    try:
+        subprocess.run(
+            command + ["--requirement", requirements],
+            check=True,
+            cwd=working_path,
+        )
+        return []
+    except subprocess.CalledProcessError:
+        pass
+
+    # Retry one requirement at a time to find out which ones don't
+    # have a binary distribution for the target platform
+    options, lines = _read_requirements(requirements)
+
+    failed = []
+    for line in lines:
+        with tempfile.NamedTemporaryFile(
+            "w", suffix=".txt", dir=os.path.dirname(requirements)
+        ) as file:
+            file.writelines(f"{option}\n" for option in options + [line])
+            file.flush()
+
+            result = subprocess.run(
+                command + ["--upgrade", "--requirement", file.name],
+                cwd=working_path,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            if result.returncode != 0:
+                failed.append(line)
+
+    return failed
+
+
+def _has_requirements(path: str) -> bool:
+    if not os.path.isfile(path):
+        return False
+
+    _, requirements = _read_requirements(path)
+    return len(requirements) > 0
+
+
+def _read_requirements(
+    path: str,
+) -> typing.Tuple[typing.List[str], typing.List[str]]:
+    """Splits a requirements file into its option lines (e.g. an index
+    url) and its requirement lines. Nested requirement files and editable
+    projects install packages, so they are requirement lines."""
+    options = []
+    requirements = []
+
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("-") and not re.match(
+                r"(--requirement|--editable|-r|-e)", line
+            ):
+                options.append(line)
+            else:
+                requirements.append(line)
+
+    return options, requirements
+
+
+def _python_version(docker_image: str) -> str:
+    match = re.search(r"python(\d+\.\d+)", docker_image)
+    return match.group(1) if match else "3.8"
+
+
+# Earliest timestamp representable in a zip entry
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+def _write_zip_entry(
+    archive: zipfile.ZipFile, arcname: str, filepath: str, reproducible: bool
+) -> None:
+    """Streams a file into the archive. Reproducible entries only depend on
+    the contents of the file: timestamps are fixed and permissions are
+    normalized to 0644 (0755 for executables).
+    """
+    if reproducible:
+        mode = 0o755 if os.access(filepath, os.X_OK) else 0o644
+
+        info = zipfile.ZipInfo(arcname, date_time=ZIP_EPOCH)
+        info.create_system = 3  # unix, so external_attr is honored
+        info.external_attr = (stat.S_IFREG | mode) << 16
+    else:
+        info = zipfile.ZipInfo.from_file(filepath, arcname)
+    info.compress_type = zipfile.ZIP_DEFLATED
+
+    with open(filepath, "rb") as src, archive.open(info, "w") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def _copy_zip(
+    source: str, output: str, overridden: typing.Iterable[str]
+) -> None:
+    """Copies the source zip leaving out the overridden entries."""
+    with zipfile.ZipFile(source) as archive:
+        names = set(archive.namelist()) & set(overridden)
+
+        if not names:
+            shutil.copyfile(source, output)
+            return
+
+        # Entries can't be removed from a zip, so it is rewritten
+        with zipfile.ZipFile(output, "w") as copy:
+            for info in archive.infolist():
+                if info.filename not in names:
+                    copy.writestr(info, archive.read(info))
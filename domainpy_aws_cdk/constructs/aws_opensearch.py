@@ -1,3 +1,5 @@
+import typing
+
 import constructs
 import aws_cdk as cdk
 import aws_cdk.aws_iam as cdk_iam
@@ -6,7 +8,7 @@ import aws_cdk.aws_opensearchservice as cdk_search
 import aws_cdk.aws_secretsmanager as cdk_secrets
 import aws_cdk.custom_resources as cdk_custom
 
-from .aws_lambda import PackageAssetCode
+from .aws_lambda import PackageAssetCode, resolve_architecture
 
 
 class EnhacedDomain(constructs.Construct):
@@ -18,9 +20,12 @@ class EnhacedDomain(constructs.Construct):
         username: str,
         data_node_instance_type: str = "t3.small.search",
         data_nodes: int = 1,
+        architecture: typing.Optional[cdk_lambda.Architecture] = None,
     ) -> None:
         super().__init__(scope, id)
 
+        architecture = resolve_architecture(self, architecture)
+
         self.username = username
 
         self.secret = cdk_secrets.Secret(
@@ -64,6 +69,7 @@ class EnhacedDomain(constructs.Construct):
             code=cdk_lambda.Code.from_inline(ON_EVENT_CODE),
             handler="index.handler",
             runtime=cdk_lambda.Runtime.PYTHON_3_8,
+            architecture=architecture,
             description="[CustomOpenSearchServiceProvider:on_event] Provider for initializing opensearchservice domains",
         )
         self.secret.grant_read(on_event_handler)
@@ -72,10 +78,19 @@ class EnhacedDomain(constructs.Construct):
             self,
             "is_complete",
             code=PackageAssetCode.from_python_inline(
-                IS_COMPLETE_CODE, requirements=["requests==2.26.0"]
+                IS_COMPLETE_CODE, architecture=architecture
             ),
+            layers=[
+                PackageAssetCode.python_layer(
+                    self,
+                    ["requests==2.26.0"],
+                    compatible_runtimes=[cdk_lambda.Runtime.PYTHON_3_8],
+                    architecture=architecture,
+                )
+            ],
             handler="index.handler",
             runtime=cdk_lambda.Runtime.PYTHON_3_8,
+            architecture=architecture,
             environment={
                 "OPENSEARCH_ENDPOINT": f"https://{self.domain.domain_endpoint}",
                 "OPENSEARCH_USERNAME": self.username,
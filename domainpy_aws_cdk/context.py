@@ -10,11 +10,17 @@ import aws_cdk.aws_sqs as cdk_sqs
 import aws_cdk.aws_dynamodb as cdk_dynamodb
 import aws_cdk.aws_lambda as cdk_lambda
 import aws_cdk.aws_lambda_event_sources as cdk_lambda_sources
+import aws_cdk.aws_applicationautoscaling as cdk_appscaling
 
 from .tracestore import TraceStore
 from .eventstore import EventStore
 from .scheduler import Scheduler
 from .constructs.aws_opensearch import Resource
+from .constructs.aws_lambda import (
+    PythonImageCode,
+    check_architecture,
+    resolve_architecture,
+)
 
 
 class Context(constructs.Construct):
@@ -23,10 +29,10 @@ class Context(constructs.Construct):
         scope: constructs.Construct,
         id: str,
         *,
-        code: cdk_lambda.Code,
+        code: typing.Union[cdk_lambda.Code, PythonImageCode],
         handler: str,
         handler_async: str,
-        runtime: cdk_lambda.Runtime,
+        runtime: typing.Optional[cdk_lambda.Runtime] = None,
         memory_size: typing.Optional[typing.Union[int, float]] = None,
         environment: typing.Optional[typing.Mapping[str, str]] = None,
         parameters: typing.Optional[typing.Mapping[str, str]] = None,
@@ -35,12 +41,34 @@ class Context(constructs.Construct):
         visibility_timeout: typing.Optional[cdk.Duration] = None,
         receive_message_wait_time: typing.Optional[cdk.Duration] = None,
         batch_size: typing.Optional[int] = None,
+        max_batching_window: typing.Optional[cdk.Duration] = None,
+        report_batch_item_failures: bool = False,
+        max_concurrency: typing.Optional[int] = None,
+        reserved_concurrent_executions_async: typing.Optional[int] = None,
+        publish: bool = False,
+        provisioned_concurrency: typing.Optional[
+            ProvisionedConcurrency
+        ] = None,
+        provisioned_concurrency_async: typing.Optional[
+            ProvisionedConcurrency
+        ] = None,
+        snap_start: bool = False,
+        architecture: typing.Optional[cdk_lambda.Architecture] = None,
+        fifo: bool = True,
+        high_throughput: bool = False,
         data_destinations: typing.Optional[
             typing.Sequence[DataDestination]
         ] = None,
     ) -> None:
         super().__init__(scope, id)
 
+        if fifo and max_batching_window is not None:
+            raise Exception(
+                "max_batching_window is not supported by FIFO queues"
+            )
+        if max_concurrency is not None and max_concurrency < 2:
+            raise Exception("max_concurrency must be at least 2")
+
         self.application = Application(
             self,
             "application",
@@ -53,14 +81,33 @@ class Context(constructs.Construct):
             parameters=parameters,
             description=description,
             timeout=timeout,
+            reserved_concurrent_executions_async=reserved_concurrent_executions_async,
+            publish=publish,
+            provisioned_concurrency=provisioned_concurrency,
+            provisioned_concurrency_async=provisioned_concurrency_async,
+            snap_start=snap_start,
+            architecture=architecture,
             data_destinations=data_destinations,
         )
 
+        # Standard queues are needed by streams that don't deliver in
+        # order, like SNS standard topics or EventBridge. High throughput
+        # FIFO queues apply the throughput limits per message group
+        deduplication_scope = None
+        fifo_throughput_limit = None
+        if fifo and high_throughput:
+            deduplication_scope = cdk_sqs.DeduplicationScope.MESSAGE_GROUP
+            fifo_throughput_limit = (
+                cdk_sqs.FifoThroughputLimit.PER_MESSAGE_GROUP_ID
+            )
+
         self.dlq = cdk_sqs.Queue(
             self,
             "dlq",
-            fifo=True,
-            content_based_deduplication=False,
+            fifo=fifo or None,
+            content_based_deduplication=False if fifo else None,
+            deduplication_scope=deduplication_scope,
+            fifo_throughput_limit=fifo_throughput_limit,
         )
 
         self.queue = cdk_sqs.Queue(
@@ -71,16 +118,38 @@ class Context(constructs.Construct):
             ),
             visibility_timeout=visibility_timeout,
             receive_message_wait_time=receive_message_wait_time,
-            fifo=True,
-            content_based_deduplication=False,
+            fifo=fifo or None,
+            content_based_deduplication=False if fifo else None,
+            deduplication_scope=deduplication_scope,
+            fifo_throughput_limit=fifo_throughput_limit,
         )
 
-        self.application.function_async.add_event_source(
+        # With report_batch_item_failures the async handler returns
+        # {"batchItemFailures": [{"itemIdentifier": message_id}, ...]}, so
+        # only the failed messages are received again
+        self.application.function_async_target.add_event_source(
             cdk_lambda_sources.SqsEventSource(
-                self.queue, batch_size=batch_size
+                self.queue,
+                batch_size=batch_size,
+                max_batching_window=max_batching_window,
+                report_batch_item_failures=report_batch_item_failures,
             )
         )
 
+        # Caps the pollers of the queue without reserving concurrency,
+        # not exposed by SqsEventSource in this CDK version
+        if max_concurrency is not None:
+            event_source_mapping = self.application.function_async_target.node.find_child(
+                f"SqsEventSource:{cdk.Names.node_unique_id(self.queue.node)}"
+            )
+            cfn_event_source_mapping = typing.cast(
+                cdk_lambda.CfnEventSourceMapping,
+                event_source_mapping.node.default_child,
+            )
+            cfn_event_source_mapping.add_property_override(
+                "ScalingConfig.MaximumConcurrency", max_concurrency
+            )
+
 
 class Application(constructs.Construct):
     def __init__(
@@ -88,49 +157,97 @@ class Application(constructs.Construct):
         scope: constructs.Construct,
         id: str,
         *,
-        code: cdk_lambda.Code,
+        code: typing.Union[cdk_lambda.Code, PythonImageCode],
         handler: str,
         handler_async: str,
-        runtime: cdk_lambda.Runtime,
+        runtime: typing.Optional[cdk_lambda.Runtime] = None,
         memory_size: typing.Optional[typing.Union[int, float]] = None,
         environment: typing.Optional[typing.Mapping[str, str]] = None,
         parameters: typing.Optional[typing.Mapping[str, str]] = None,
         description: typing.Optional[str] = None,
         timeout: typing.Optional[cdk.Duration] = None,
+        reserved_concurrent_executions_async: typing.Optional[int] = None,
+        publish: bool = False,
+        provisioned_concurrency: typing.Optional[
+            ProvisionedConcurrency
+        ] = None,
+        provisioned_concurrency_async: typing.Optional[
+            ProvisionedConcurrency
+        ] = None,
+        snap_start: bool = False,
+        architecture: typing.Optional[cdk_lambda.Architecture] = None,
         data_destinations: typing.Optional[
             typing.Sequence[DataDestination]
         ] = None,
     ) -> None:
         super().__init__(scope, id)
 
-        self.function = cdk_lambda.Function(
-            self,
+        if snap_start:
+            self._check_snap_start(
+                code,
+                runtime,
+                provisioned_concurrency or provisioned_concurrency_async,
+            )
+
+        architecture = resolve_architecture(self, architecture)
+
+        self.function = self._create_function(
             "function",
             code=code,
             handler=handler,
             runtime=runtime,
+            architecture=architecture,
             memory_size=memory_size,
             environment=environment,
             description=description
             or "[Context] Business code for handling messages (sync)",
             timeout=timeout,
-            tracing=cdk_lambda.Tracing.ACTIVE,
         )
 
-        self.function_async = cdk_lambda.Function(
-            self,
+        self.function_async = self._create_function(
             "function_async",
             code=code,
             handler=handler_async,
             runtime=runtime,
+            architecture=architecture,
             memory_size=memory_size,
             environment=environment,
             description=description
             or "[Context] Business code for handling messages (async)",
             timeout=timeout,
-            tracing=cdk_lambda.Tracing.ACTIVE,
+            reserved_concurrent_executions=reserved_concurrent_executions_async,
         )
 
+        # Versions are published from a snapshot of the initialized
+        # function, see domainpy_aws_cdk.runtime.before_snapshot
+        if snap_start:
+            publish = True
+            # Unknown to this CDK version, but changes the published version
+            cdk_lambda.Function.classify_version_property("SnapStart", True)
+            for fn in self.functions:
+                cfn_function = typing.cast(
+                    cdk_lambda.CfnFunction, fn.node.default_child
+                )
+                cfn_function.add_property_override(
+                    "SnapStart", {"ApplyOn": "PublishedVersions"}
+                )
+
+        # Provisioned concurrency is set on an alias of a published version,
+        # which is then invoked instead of the function
+        self.alias: typing.Optional[cdk_lambda.Alias] = None
+        if publish or provisioned_concurrency is not None:
+            self.alias = self._create_alias(
+                "function_alias", self.function, provisioned_concurrency
+            )
+
+        self.alias_async: typing.Optional[cdk_lambda.Alias] = None
+        if publish or provisioned_concurrency_async is not None:
+            self.alias_async = self._create_alias(
+                "function_async_alias",
+                self.function_async,
+                provisioned_concurrency_async,
+            )
+
         # Create parameter in AWS SSM Parameter Store
         # and grant read to functions
         if parameters:
@@ -153,6 +270,166 @@ class Application(constructs.Construct):
         yield self.function
         yield self.function_async
 
+    @property
+    def function_target(self) -> cdk_lambda.IFunction:
+        """The alias of function when published, function otherwise."""
+        return self.alias or self.function
+
+    @property
+    def function_async_target(self) -> cdk_lambda.IFunction:
+        """The alias of function_async when published, function_async
+        otherwise."""
+        return self.alias_async or self.function_async
+
+    def _check_snap_start(
+        self,
+        code: typing.Union[cdk_lambda.Code, PythonImageCode],
+        runtime: typing.Optional[cdk_lambda.Runtime],
+        provisioned_concurrency: typing.Optional[ProvisionedConcurrency],
+    ) -> None:
+        if isinstance(code, PythonImageCode):
+            raise Exception("snap_start is not supported by container images")
+
+        if runtime is not None and runtime.name.startswith("python"):
+            major, minor = runtime.name[len("python") :].split(".")
+            if (int(major), int(minor)) < (3, 12):
+                raise Exception("snap_start requires python3.12 or later")
+
+        if provisioned_concurrency is not None:
+            raise Exception(
+                "snap_start can't be combined with provisioned concurrency"
+            )
+
+    def _create_alias(
+        self,
+        id: str,
+        function: cdk_lambda.Function,
+        provisioned_concurrency: typing.Optional[ProvisionedConcurrency],
+    ) -> cdk_lambda.Alias:
+        alias = cdk_lambda.Alias(
+            self,
+            id,
+            alias_name="live",
+            version=function.current_version,
+            provisioned_concurrent_executions=(
+                provisioned_concurrency.min_capacity
+                if provisioned_concurrency
+                else None
+            ),
+        )
+
+        if provisioned_concurrency is not None:
+            provisioned_concurrency.bind(alias)
+
+        return alias
+
+    def _create_function(
+        self,
+        id: str,
+        *,
+        code: typing.Union[cdk_lambda.Code, PythonImageCode],
+        handler: str,
+        runtime: typing.Optional[cdk_lambda.Runtime],
+        architecture: cdk_lambda.Architecture,
+        **options: typing.Any,
+    ) -> cdk_lambda.Function:
+        if isinstance(code, PythonImageCode):
+            # The handler is the command of the image
+            return cdk_lambda.DockerImageFunction(
+                self,
+                id,
+                code=code.for_handler(handler, architecture=architecture),
+                architecture=architecture,
+                tracing=cdk_lambda.Tracing.ACTIVE,
+                **options,
+            )
+
+        if runtime is None:
+            raise Exception("runtime is required for non container code")
+
+        check_architecture(code, architecture)
+
+        return cdk_lambda.Function(
+            self,
+            id,
+            code=code,
+            handler=handler,
+            runtime=runtime,
+            architecture=architecture,
+            tracing=cdk_lambda.Tracing.ACTIVE,
+            **options,
+        )
+
+
+class ProvisionedConcurrency:
+    """Provisioned concurrency of a Context function alias.
+
+    With max_capacity, it is scaled between min_capacity and max_capacity
+    to keep its utilization around utilization_target. With
+    business_hours_capacity, the minimum is raised to it from
+    business_hours_start to business_hours_end, weekdays from 8:00 to
+    18:00 UTC by default.
+    """
+
+    def __init__(
+        self,
+        min_capacity: int,
+        *,
+        max_capacity: typing.Optional[int] = None,
+        utilization_target: float = 0.7,
+        business_hours_capacity: typing.Optional[int] = None,
+        business_hours_start: typing.Optional[cdk_appscaling.Schedule] = None,
+        business_hours_end: typing.Optional[cdk_appscaling.Schedule] = None,
+    ) -> None:
+        if max_capacity is not None and max_capacity < min_capacity:
+            raise Exception("max_capacity must not be less than min_capacity")
+
+        self.min_capacity = min_capacity
+        self.max_capacity = max_capacity
+        self.utilization_target = utilization_target
+        self.business_hours_capacity = business_hours_capacity
+        self.business_hours_start = (
+            business_hours_start
+            or cdk_appscaling.Schedule.cron(
+                hour="8", minute="0", week_day="MON-FRI"
+            )
+        )
+        self.business_hours_end = (
+            business_hours_end
+            or cdk_appscaling.Schedule.cron(
+                hour="18", minute="0", week_day="MON-FRI"
+            )
+        )
+
+    def bind(self, alias: cdk_lambda.Alias) -> None:
+        if self.max_capacity is None and self.business_hours_capacity is None:
+            return
+
+        max_capacity = max(
+            self.max_capacity or self.min_capacity,
+            self.business_hours_capacity or self.min_capacity,
+        )
+        scaling = alias.add_auto_scaling(
+            min_capacity=self.min_capacity, max_capacity=max_capacity
+        )
+
+        if self.max_capacity is not None:
+            scaling.scale_on_utilization(
+                utilization_target=self.utilization_target
+            )
+
+        if self.business_hours_capacity is not None:
+            scaling.scale_on_schedule(
+                "business_hours_start",
+                schedule=self.business_hours_start,
+                min_capacity=self.business_hours_capacity,
+            )
+            scaling.scale_on_schedule(
+                "business_hours_end",
+                schedule=self.business_hours_end,
+                min_capacity=self.min_capacity,
+            )
+
 
 class DataDestination(abc.ABC):
     @abc.abstractmethod
@@ -194,12 +471,33 @@ class SchedulerDestination(DataDestination):
         self.scheduler = scheduler
 
     def bind(self, application: Application) -> None:
+        # Read by domainpy_aws_cdk.runtime.schedule
         for fn in application.functions:
             fn.add_environment(
-                f"{self.name}_SCHEDULER_ARN",
-                self.scheduler.state_machine.state_machine_arn,
+                f"{self.name}_SCHEDULER_ENGINE", self.scheduler.engine
+            )
+            fn.add_environment(
+                f"{self.name}_SCHEDULER_QUEUE_URL",
+                self.scheduler.queue.queue_url,
             )
-            self.scheduler.state_machine.grant_start_execution(fn)
+            self.scheduler.queue.grant_send_messages(fn)
+
+            if self.scheduler.state_machine is not None:
+                fn.add_environment(
+                    f"{self.name}_SCHEDULER_ARN",
+                    self.scheduler.state_machine.state_machine_arn,
+                )
+                self.scheduler.state_machine.grant_start_execution(fn)
+
+            if self.scheduler.table is not None:
+                fn.add_environment(
+                    f"{self.name}_SCHEDULER_TABLE_NAME",
+                    self.scheduler.table.table_name,
+                )
+                fn.add_environment(
+                    f"{self.name}_SCHEDULER_SHARDS", str(self.scheduler.shards)
+                )
+                self.scheduler.table.grant_write_data(fn)
 
 
 class DynamodbTableDestination(DataDestination):
@@ -163,7 +163,7 @@ class Gateway(constructs.Construct):
         role.add_to_policy(
             cdk_iam.PolicyStatement(
                 actions=["lambda:InvokeFunction"],
-                resources=[context.application.function.function_arn],
+                resources=[context.application.function_target.function_arn],
             )
         )
         role.add_to_policy(
@@ -241,7 +241,7 @@ class ContextCommandIntegration(LambdaIntegrationNoPermission):
         role: cdk_iam.IRole,
     ) -> None:
         super().__init__(
-            context.application.function,
+            context.application.function_target,
             proxy=False,
             credentials_role=role,
             passthrough_behavior=cdk_apigateway.PassthroughBehavior.NEVER,
@@ -342,7 +342,7 @@ class ContextQueryIntegration(LambdaIntegrationNoPermission):
         role: cdk_iam.IRole,
     ) -> None:
         super().__init__(
-            context.application.function,
+            context.application.function_target,
             proxy=False,
             credentials_role=role,
             passthrough_behavior=cdk_apigateway.PassthroughBehavior.NEVER,
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import typing
+
 import constructs
 import aws_cdk as cdk
 import aws_cdk.aws_s3 as cdk_s3
+import aws_cdk.aws_lambda as cdk_lambda
 
 from .constructs.aws_kinesisfirehose import S3DeliveryStream
 
@@ -31,9 +34,13 @@ class Dam(constructs.Construct):
         construct_id: str,
         *,
         lake: Lake,
+        architecture: typing.Optional[cdk_lambda.Architecture] = None,
     ) -> None:
         super().__init__(scope, construct_id)
 
         self.firehose = S3DeliveryStream(
-            self, "delivery_stream", bucket=lake.bucket
+            self,
+            "delivery_stream",
+            bucket=lake.bucket,
+            architecture=architecture,
         )
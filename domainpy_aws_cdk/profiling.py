@@ -0,0 +1,262 @@
+"""Offline cold start profiling of packaged Lambda assets.
+
+Unpacks a package produced by PackageAssetCode (and its layers), imports
+the handler in a clean interpreter with ``-X importtime`` and reports the
+slowest imports, the init time and the peak memory, e.g.::
+
+    python -m domainpy_aws_cdk.profiling cdk.out/package.<hash>.zip \\
+        index.handler --layer cdk.out/package.<hash>.zip --max-init-time 1.5
+"""
+import os
+import sys
+import json
+import typing
+import zipfile
+import argparse
+import tempfile
+import subprocess
+
+
+RUNNER_CODE = """
+import sys
+import json
+import time
+import resource
+import importlib
+
+module_name, _, function_name = sys.argv[1].rpartition(".")
+
+sys.stderr.write("%s\\n" % sys.argv[2])
+sys.stderr.flush()
+
+start = time.perf_counter()
+module = importlib.import_module(module_name)
+getattr(module, function_name)
+init_time = time.perf_counter() - start
+
+# ru_maxrss is in KiB on Linux
+print(json.dumps({
+    "init_time": init_time,
+    "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+}))
+"""
+
+# Written by the runner right before importing the handler, imports
+# reported before it belong to the runner itself
+MARKER = "-- domainpy_aws_cdk.profiling --"
+
+
+class ImportTime:
+    def __init__(
+        self, name: str, depth: int, self_time: float, cumulative_time: float
+    ) -> None:
+        self.name = name
+        self.depth = depth
+        self.self_time = self_time
+        self.cumulative_time = cumulative_time
+
+
+class ColdStartReport:
+    def __init__(
+        self,
+        handler: str,
+        init_time: float,
+        max_rss: int,
+        imports: typing.Sequence[ImportTime],
+    ) -> None:
+        self.handler = handler
+        self.init_time = init_time
+        self.max_rss = max_rss
+        self.imports = imports
+
+    def slowest_imports(self, count: int = 15) -> typing.List[ImportTime]:
+        return sorted(
+            self.imports, key=lambda i: i.cumulative_time, reverse=True
+        )[:count]
+
+    def format(self, count: int = 15) -> str:
+        lines = [
+            f"Handler: {self.handler}",
+            f"Init time: {self.init_time * 1000:.1f} ms",
+            f"Max memory: {self.max_rss / 1024 ** 2:.1f} MiB",
+            "",
+            f"{'Self [ms]':>10} {'Cumulative [ms]':>16}  Module",
+        ]
+        for i in self.slowest_imports(count):
+            lines.append(
+                f"{i.self_time * 1000:>10.1f} {i.cumulative_time * 1000:>16.1f}"
+                f"  {'  ' * i.depth}{i.name}"
+            )
+        return "\n".join(lines)
+
+
+class ColdStartThresholdExceeded(Exception):
+    def __init__(self, report: ColdStartReport, max_init_time: float) -> None:
+        super().__init__(
+            f"Init time of {report.handler} is "
+            f"{report.init_time * 1000:.1f} ms, over the threshold of "
+            f"{max_init_time * 1000:.1f} ms"
+        )
+        self.report = report
+        self.max_init_time = max_init_time
+
+
+def profile_cold_start(
+    package: str,
+    handler: str,
+    *,
+    layers: typing.Sequence[str] = [],
+    environment: typing.Optional[typing.Mapping[str, str]] = None,
+    python: str = sys.executable,
+    max_init_time: typing.Optional[float] = None,
+) -> ColdStartReport:
+    """Imports the handler of a packaged asset in a clean interpreter.
+
+    Layers are unpacked in order and their python/ directories are added
+    to the path after the package, as Lambda does with /opt/python.
+    Raises ColdStartThresholdExceeded when the init time (in seconds) goes
+    over max_init_time.
+    """
+    with tempfile.TemporaryDirectory() as work_path:
+        task_root = os.path.join(work_path, "task")
+        with zipfile.ZipFile(package) as archive:
+            archive.extractall(task_root)
+
+        paths = [task_root]
+        for index, layer in enumerate(layers):
+            layer_root = os.path.join(work_path, f"layer{index}")
+            with zipfile.ZipFile(layer) as archive:
+                archive.extractall(layer_root)
+            paths.append(os.path.join(layer_root, "python"))
+
+        env = {
+            "PATH": os.environ.get("PATH", ""),
+            "AWS_DEFAULT_REGION": "us-east-1",
+            "AWS_REGION": "us-east-1",
+            "LAMBDA_TASK_ROOT": task_root,
+            **(environment or {}),
+            "PYTHONPATH": os.pathsep.join(paths),
+            "PYTHONDONTWRITEBYTECODE": "1",
+        }
+
+        result = subprocess.run(
+            [python, "-s", "-X", "importtime", "-c", RUNNER_CODE]
+            + [handler, MARKER],
+            cwd=task_root,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+
+    if result.returncode != 0:
+        raise Exception(
+            f"Couldn't import {handler}:\n{_strip_import_times(result.stderr)}"
+        )
+
+    stats = json.loads(result.stdout.strip().splitlines()[-1])
+    report = ColdStartReport(
+        handler,
+        init_time=stats["init_time"],
+        max_rss=stats["max_rss"],
+        imports=_parse_import_times(result.stderr),
+    )
+
+    if max_init_time is not None and report.init_time > max_init_time:
+        raise ColdStartThresholdExceeded(report, max_init_time)
+
+    return report
+
+
+def _parse_import_times(output: str) -> typing.List[ImportTime]:
+    imports = []
+
+    lines = output.splitlines()
+    if MARKER in lines:
+        lines = lines[lines.index(MARKER) + 1 :]
+
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+
+        # import time: self [us] | cumulative | imported package
+        try:
+            self_time, cumulative_time, name = line[
+                len("import time:") :
+            ].split("|")
+            self_us = int(self_time)
+            cumulative_us = int(cumulative_time)
+        except ValueError:
+            continue  # header
+
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append(
+            ImportTime(
+                name.strip(), depth, self_us / 10**6, cumulative_us / 10**6
+            )
+        )
+
+    return imports
+
+
+def _strip_import_times(output: str) -> str:
+    return "\n".join(
+        line
+        for line in output.splitlines()
+        if not line.startswith("import time:") and line != MARKER
+    )
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m domainpy_aws_cdk.profiling",
+        description="Profiles the cold start of a packaged Lambda asset",
+    )
+    parser.add_argument("package", help="zip produced by PackageAssetCode")
+    parser.add_argument("handler", help="e.g. index.handler")
+    parser.add_argument(
+        "--layer",
+        action="append",
+        default=[],
+        help="layer zip, can be repeated",
+    )
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="environment variable for the handler, can be repeated",
+    )
+    parser.add_argument(
+        "--python",
+        default=sys.executable,
+        help="interpreter matching the Lambda runtime",
+    )
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument(
+        "--max-init-time",
+        type=float,
+        help="fail when the init time goes over this many seconds",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        report = profile_cold_start(
+            args.package,
+            args.handler,
+            layers=args.layer,
+            environment=dict(e.split("=", 1) for e in args.env),
+            python=args.python,
+            max_init_time=args.max_init_time,
+        )
+    except ColdStartThresholdExceeded as error:
+        print(error.report.format(args.top))
+        print()
+        print(error, file=sys.stderr)
+        return 1
+
+    print(report.format(args.top))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,366 @@
+"""Helpers for the handlers running inside the deployed functions.
+
+Only depends on boto3, which the Lambda Python runtime already provides,
+so it can be bundled with the application code without aws-cdk-lib.
+"""
+import os
+import json
+import uuid
+import random
+import typing
+import datetime
+
+
+# Longest SQS DelaySeconds, later messages go through the scheduler engine
+MAX_QUEUE_DELAY = datetime.timedelta(minutes=15)
+
+# SendMessageBatch and BatchWriteItem limits
+MAX_QUEUE_BATCH = 10
+MAX_QUEUE_BATCH_SIZE = 256 * 1024
+MAX_TABLE_BATCH = 25
+
+# Step Functions input limit, and batches per execution to stay well
+# under the execution history limit
+MAX_EXECUTION_INPUT = 256 * 1024
+MAX_EXECUTION_BATCHES = 1000
+
+MAX_ATTEMPTS = 3
+
+# How long delivered message ids are remembered by is_duplicate, well
+# beyond the redelivery of standard SNS topics and EventBridge buses
+DEDUPLICATION_TTL = datetime.timedelta(days=1)
+
+Schedule = typing.Tuple[typing.Union[datetime.datetime, str], dict]
+
+_clients: typing.Dict[str, typing.Any] = {}
+
+
+def _client(service: str) -> typing.Any:
+    if service not in _clients:
+        import boto3  # type: ignore[import]
+
+        _clients[service] = boto3.client(service)
+    return _clients[service]
+
+
+def _snapshot_restore() -> typing.Any:
+    # Only provided by the runtime when initializing for a SnapStart
+    # snapshot
+    if os.getenv("AWS_LAMBDA_INITIALIZATION_TYPE") != "snap-start":
+        return None
+    try:
+        import snapshot_restore_py  # type: ignore[import]
+    except ImportError:
+        return None
+    return snapshot_restore_py
+
+
+Hook = typing.Callable[[], typing.Any]
+
+
+def before_snapshot(hook: Hook) -> Hook:
+    """Registers a warm up hook of the handler module, e.g. importing the
+    domain models or building clients with warm_clients.
+
+    With Context(snap_start=True) it runs before the snapshot is taken, so
+    restored functions start warm, otherwise right away in the init phase.
+    Can be used as a decorator.
+    """
+    snapshot_restore = _snapshot_restore()
+    if snapshot_restore is None:
+        hook()
+    else:
+        snapshot_restore.register_before_snapshot(hook)
+    return hook
+
+
+def after_restore(hook: Hook) -> Hook:
+    """Registers a hook run when a function is restored from its snapshot,
+    to refresh state that must be unique per execution environment.
+
+    Never runs without Context(snap_start=True). Can be used as a
+    decorator.
+    """
+    snapshot_restore = _snapshot_restore()
+    if snapshot_restore is not None:
+        snapshot_restore.register_after_restore(hook)
+    return hook
+
+
+def warm_clients(*services: str) -> None:
+    """Builds the boto3 clients used by these helpers ahead of the first
+    invocation, e.g. warm_clients("sqs", "s3") in a before_snapshot hook."""
+    for service in services:
+        _client(service)
+
+
+# Restored functions would otherwise share the shard choices of the
+# snapshot
+after_restore(random.seed)
+
+
+def resolve_claim_check(body: typing.Union[str, bytes, dict]) -> dict:
+    """Returns the stream message, fetching it from the claim check bucket
+    when the stream published a pointer instead of the message.
+
+    Takes the body of the SQS record delivered to the Context queue.
+    """
+    message: dict = body if isinstance(body, dict) else json.loads(body)
+
+    pointer = message.get("claim_check")
+    if pointer is None:
+        return message
+
+    response = _client("s3").get_object(
+        Bucket=pointer["bucket"], Key=pointer["key"]
+    )
+    return json.loads(response["Body"].read())
+
+
+def is_duplicate(
+    name: str,
+    message_id: str,
+    *,
+    ttl: datetime.timedelta = DEDUPLICATION_TTL,
+) -> bool:
+    """Returns whether message_id was already delivered, recording it
+    otherwise, for the consumers of the transports which deliver at least
+    once (SnsTransport(fifo=False) and EventBridgeTransport).
+
+    Ids are recorded in the table bound with DynamodbTableDestination(name,
+    ...), which partition key is message_id (string), with expires_at as
+    its time to live attribute. A handler failing after the check must
+    call forget_message, so the redelivered message is handled.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    client = _client("dynamodb")
+
+    try:
+        client.put_item(
+            TableName=os.environ[f"{name}_TABLE_NAME"],
+            Item={
+                "message_id": {"S": message_id},
+                "expires_at": {"N": str(int((now + ttl).timestamp()))},
+            },
+            # Expired items linger until the time to live deletes them
+            ConditionExpression=(
+                "attribute_not_exists(message_id) OR expires_at < :now"
+            ),
+            ExpressionAttributeValues={
+                ":now": {"N": str(int(now.timestamp()))}
+            },
+        )
+    except client.exceptions.ConditionalCheckFailedException:
+        return True
+    return False
+
+
+def forget_message(name: str, message_id: str) -> None:
+    """Removes message_id recorded by is_duplicate, e.g. when handling the
+    message failed and it is going to be delivered again."""
+    _client("dynamodb").delete_item(
+        TableName=os.environ[f"{name}_TABLE_NAME"],
+        Key={"message_id": {"S": message_id}},
+    )
+
+
+def schedule(
+    name: str,
+    publish_at: typing.Union[datetime.datetime, str],
+    payload: dict,
+) -> None:
+    """Schedules the payload to be published into the stream at publish_at
+    by the scheduler bound with SchedulerDestination(name, ...).
+
+    Naive datetimes are taken as UTC.
+    """
+    publish_at = _parse_timestamp(publish_at)
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if publish_at - now < MAX_QUEUE_DELAY:
+        _client("sqs").send_message(
+            QueueUrl=os.environ[f"{name}_SCHEDULER_QUEUE_URL"],
+            MessageBody=_body(publish_at, payload),
+            DelaySeconds=_delay(publish_at, now),
+        )
+        return
+
+    engine = os.environ[f"{name}_SCHEDULER_ENGINE"]
+    if engine == "table":
+        _client("dynamodb").put_item(
+            TableName=os.environ[f"{name}_SCHEDULER_TABLE_NAME"],
+            Item=_table_item(name, publish_at, payload),
+        )
+    else:
+        _client("stepfunctions").start_execution(
+            stateMachineArn=os.environ[f"{name}_SCHEDULER_ARN"],
+            input=_body(publish_at, payload),
+        )
+
+
+def schedule_batch(name: str, schedules: typing.Iterable[Schedule]) -> None:
+    """Schedules many (publish_at, payload) at once, see schedule.
+
+    With the state_machine engine, messages sharing a publish_at are sent
+    together by a single execution. Raises when some couldn't be
+    scheduled.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    queued = []
+    later = []
+    for publish_at, payload in schedules:
+        publish_at = _parse_timestamp(publish_at)
+        if publish_at - now < MAX_QUEUE_DELAY:
+            queued.append((publish_at, payload))
+        else:
+            later.append((publish_at, payload))
+
+    queue_url = os.environ[f"{name}_SCHEDULER_QUEUE_URL"]
+    for start in range(0, len(queued), MAX_QUEUE_BATCH):
+        chunk = queued[start : start + MAX_QUEUE_BATCH]
+        response = _client("sqs").send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {
+                    "Id": str(index),
+                    "MessageBody": _body(publish_at, payload),
+                    "DelaySeconds": _delay(publish_at, now),
+                }
+                for index, (publish_at, payload) in enumerate(chunk)
+            ],
+        )
+        if response.get("Failed"):
+            raise Exception(f"Couldn't schedule: {response['Failed']}")
+
+    if not later:
+        return
+
+    engine = os.environ[f"{name}_SCHEDULER_ENGINE"]
+    if engine == "table":
+        _put_table_items(name, later)
+    else:
+        _start_batch_executions(name, later)
+
+
+def _put_table_items(
+    name: str,
+    schedules: typing.Sequence[typing.Tuple[datetime.datetime, dict]],
+) -> None:
+    table_name = os.environ[f"{name}_SCHEDULER_TABLE_NAME"]
+
+    for start in range(0, len(schedules), MAX_TABLE_BATCH):
+        requests = [
+            {"PutRequest": {"Item": _table_item(name, publish_at, payload)}}
+            for publish_at, payload in schedules[
+                start : start + MAX_TABLE_BATCH
+            ]
+        ]
+        for _ in range(MAX_ATTEMPTS):
+            response = _client("dynamodb").batch_write_item(
+                RequestItems={table_name: requests}
+            )
+            requests = response.get("UnprocessedItems", {}).get(table_name)
+            if not requests:
+                break
+        else:
+            raise Exception(f"Couldn't schedule {len(requests)} messages")
+
+
+def _start_batch_executions(
+    name: str,
+    schedules: typing.Sequence[typing.Tuple[datetime.datetime, dict]],
+) -> None:
+    by_publish_at: typing.Dict[str, typing.List[str]] = {}
+    for publish_at, payload in schedules:
+        by_publish_at.setdefault(_format_timestamp(publish_at), []).append(
+            _body(publish_at, payload)
+        )
+
+    # Batches hold up to 10 messages of the same publish_at, executions
+    # as many batches as fit in their input
+    batches = []
+    for timestamp, bodies in sorted(by_publish_at.items()):
+        entries: typing.List[dict] = []
+        entries_size = 0
+        for body in bodies:
+            if entries and (
+                len(entries) == MAX_QUEUE_BATCH
+                or entries_size + len(body) > MAX_QUEUE_BATCH_SIZE
+            ):
+                batches.append({"publish_at": timestamp, "entries": entries})
+                entries = []
+                entries_size = 0
+
+            entries.append({"Id": str(len(entries)), "MessageBody": body})
+            entries_size += len(body)
+
+        batches.append({"publish_at": timestamp, "entries": entries})
+
+    state_machine_arn = os.environ[f"{name}_SCHEDULER_ARN"]
+
+    execution: typing.List[dict] = []
+    execution_size = 0
+    for batch in batches:
+        size = len(json.dumps(batch)) + 2
+        if execution and (
+            len(execution) == MAX_EXECUTION_BATCHES
+            or execution_size + size > MAX_EXECUTION_INPUT - 16
+        ):
+            _client("stepfunctions").start_execution(
+                stateMachineArn=state_machine_arn,
+                input=json.dumps({"batches": execution}),
+            )
+            execution = []
+            execution_size = 0
+
+        execution.append(batch)
+        execution_size += size
+
+    if execution:
+        _client("stepfunctions").start_execution(
+            stateMachineArn=state_machine_arn,
+            input=json.dumps({"batches": execution}),
+        )
+
+
+def _body(publish_at: datetime.datetime, payload: dict) -> str:
+    return json.dumps(
+        {"publish_at": _format_timestamp(publish_at), "payload": payload}
+    )
+
+
+def _delay(publish_at: datetime.datetime, now: datetime.datetime) -> int:
+    return max(0, int((publish_at - now).total_seconds()))
+
+
+def _table_item(
+    name: str, publish_at: datetime.datetime, payload: dict
+) -> dict:
+    # Spread over shards so a busy minute is not a hot partition
+    shards = int(os.environ[f"{name}_SCHEDULER_SHARDS"])
+    timestamp = _format_timestamp(publish_at)
+    return {
+        "bucket": {
+            "S": f"{publish_at:%Y-%m-%dT%H:%M}#{random.randrange(shards)}"
+        },
+        "id": {"S": f"{timestamp}#{uuid.uuid4()}"},
+        "publish_at": {"S": timestamp},
+        "payload": {"S": json.dumps(payload)},
+    }
+
+
+def _format_timestamp(timestamp: datetime.datetime) -> str:
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _parse_timestamp(
+    timestamp: typing.Union[datetime.datetime, str]
+) -> datetime.datetime:
+    if isinstance(timestamp, str):
+        timestamp = datetime.datetime.fromisoformat(
+            timestamp.replace("Z", "+00:00")
+        )
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp.astimezone(datetime.timezone.utc)
@@ -1,43 +1,321 @@
 import typing
 
 import constructs
+import aws_cdk as cdk
 import aws_cdk.aws_sqs as cdk_sqs
+import aws_cdk.aws_events as cdk_events
+import aws_cdk.aws_lambda as cdk_lambda
+import aws_cdk.aws_dynamodb as cdk_dynamodb
+import aws_cdk.aws_events_targets as cdk_events_targets
 import aws_cdk.aws_stepfunctions as cdk_stepfunctions
 import aws_cdk.aws_stepfunctions_tasks as cdk_stepfunctions_tasks
 
+from .constructs.aws_lambda import PackageAssetCode, resolve_architecture
+
 
 class Scheduler(constructs.Construct):
+    """Sends scheduled messages to its queue at their publish_at.
+
+    The state_machine engine starts one execution per message, or one per
+    batch of messages. The table engine stores messages in a table
+    partitioned by minute (and shard) and sweeps the due ones every
+    minute, for high volumes. Handlers schedule with
+    domainpy_aws_cdk.runtime.schedule and schedule_batch, which send
+    messages due in less than 15 minutes straight to the queue with a
+    delay.
+    """
+
+    ENGINES = ["state_machine", "table"]
+
     def __init__(
         self,
         scope: constructs.Construct,
         id: str,
         *,
         export_name: typing.Optional[str] = None,
+        engine: str = "state_machine",
+        shards: int = 10,
+        architecture: typing.Optional[cdk_lambda.Architecture] = None,
     ) -> None:
         super().__init__(scope, id)
 
+        if engine not in self.ENGINES:
+            raise Exception(
+                f"Unknown scheduler engine {engine}, expected one of "
+                f"{', '.join(self.ENGINES)}"
+            )
+
+        self.engine = engine
+        self.shards = shards
+
         self.queue = cdk_sqs.Queue(self, "queue")
 
-        self.state_machine = cdk_stepfunctions.StateMachine(
-            self,
-            "scheduler",
-            definition=(
+        self.state_machine: typing.Optional[
+            cdk_stepfunctions.StateMachine
+        ] = None
+        self.table: typing.Optional[cdk_dynamodb.Table] = None
+
+        if engine == "state_machine":
+            single = cdk_stepfunctions.Wait(
+                self,
+                "wait",
+                time=cdk_stepfunctions.WaitTime.timestamp_path("$.publish_at"),
+            ).next(
+                cdk_stepfunctions_tasks.SqsSendMessage(
+                    self,
+                    "send_to_queue",
+                    message_body=cdk_stepfunctions.TaskInput.from_json_path_at(
+                        "$"
+                    ),
+                    queue=self.queue,
+                )
+            )
+
+            # Batch executions carry many {publish_at, entries} items, each
+            # entries being a SendMessageBatch list of at most 10 messages
+            send_batch = cdk_stepfunctions_tasks.CallAwsService(
+                self,
+                "send_batch_to_queue",
+                service="sqs",
+                action="sendMessageBatch",
+                iam_action="sqs:SendMessage",
+                iam_resources=[self.queue.queue_arn],
+                parameters={
+                    "QueueUrl": self.queue.queue_url,
+                    "Entries.$": "$.entries",
+                },
+                result_path="$.result",
+            )
+            send_batch.add_retry(max_attempts=3)
+
+            # SendMessageBatch reports failed entries in a successful
+            # response, their Id being the index in entries; they are sent
+            # one at a time, and the execution fails if they still can't be
+            resend_failed = cdk_stepfunctions.Map(
+                self,
+                "resend_failed",
+                items_path="$.result.Failed",
+                parameters={
+                    "id.$": "$$.Map.Item.Value.Id",
+                    "entries.$": "$.entries",
+                },
+                result_path=cdk_stepfunctions.JsonPath.DISCARD,
+            )
+            resend = cdk_stepfunctions_tasks.SqsSendMessage(
+                self,
+                "resend_to_queue",
+                message_body=cdk_stepfunctions.TaskInput.from_json_path_at(
+                    "$.entry.MessageBody"
+                ),
+                queue=self.queue,
+            )
+            resend.add_retry(max_attempts=3)
+            resend_failed.iterator(
+                cdk_stepfunctions.Pass(
+                    self,
+                    "failed_entry",
+                    parameters={
+                        "entry.$": "States.ArrayGetItem($.entries, States.StringToJson($.id))"
+                    },
+                ).next(resend)
+            )
+
+            check_batch = (
+                cdk_stepfunctions.Choice(self, "has_failed_entries")
+                .when(
+                    cdk_stepfunctions.Condition.is_present(
+                        "$.result.Failed[0]"
+                    ),
+                    resend_failed,
+                )
+                .otherwise(cdk_stepfunctions.Pass(self, "batch_sent"))
+            )
+
+            batch = cdk_stepfunctions.Map(
+                self,
+                "batches",
+                items_path="$.batches",
+                result_path=cdk_stepfunctions.JsonPath.DISCARD,
+            ).iterator(
                 cdk_stepfunctions.Wait(
                     self,
-                    "wait",
+                    "wait_batch",
                     time=cdk_stepfunctions.WaitTime.timestamp_path(
                         "$.publish_at"
                     ),
-                ).next(
-                    cdk_stepfunctions_tasks.SqsSendMessage(
-                        self,
-                        "send_to_queue",
-                        message_body=cdk_stepfunctions.TaskInput.from_json_path_at(
-                            "$"
-                        ),
-                        queue=self.queue,
-                    )
                 )
-            ),
-            tracing_enabled=True,
+                .next(send_batch)
+                .next(check_batch)
+            )
+
+            self.state_machine = cdk_stepfunctions.StateMachine(
+                self,
+                "scheduler",
+                definition=(
+                    cdk_stepfunctions.Choice(self, "is_batch")
+                    .when(
+                        cdk_stepfunctions.Condition.is_present("$.batches"),
+                        batch,
+                    )
+                    .otherwise(single)
+                ),
+                tracing_enabled=True,
+            )
+        else:
+            self.table = cdk_dynamodb.Table(
+                self,
+                "table",
+                billing_mode=cdk_dynamodb.BillingMode.PAY_PER_REQUEST,
+                removal_policy=cdk.RemovalPolicy.DESTROY,
+                partition_key=cdk_dynamodb.Attribute(
+                    name="bucket", type=cdk_dynamodb.AttributeType.STRING
+                ),
+                sort_key=cdk_dynamodb.Attribute(
+                    name="id", type=cdk_dynamodb.AttributeType.STRING
+                ),
+            )
+
+            # A single sweeper at a time, so messages are not sent twice
+            architecture = resolve_architecture(self, architecture)
+            sweeper = cdk_lambda.Function(
+                self,
+                "sweeper",
+                code=PackageAssetCode.from_python_inline(
+                    SCHEDULER_SWEEPER_CODE, architecture=architecture
+                ),
+                handler="index.handler",
+                runtime=cdk_lambda.Runtime.PYTHON_3_8,
+                architecture=architecture,
+                environment={
+                    "TABLE_NAME": self.table.table_name,
+                    "QUEUE_URL": self.queue.queue_url,
+                    "SHARDS": str(shards),
+                },
+                description="[Scheduler] Send due messages to the queue",
+                reserved_concurrent_executions=1,
+                timeout=cdk.Duration.minutes(1),
+                tracing=cdk_lambda.Tracing.ACTIVE,
+            )
+            self.table.grant_read_write_data(sweeper)
+            self.queue.grant_send_messages(sweeper)
+
+            cdk_events.Rule(
+                self,
+                "sweep",
+                schedule=cdk_events.Schedule.rate(cdk.Duration.minutes(1)),
+                targets=[cdk_events_targets.LambdaFunction(sweeper)],
+            )
+
+
+SCHEDULER_SWEEPER_CODE = """
+import os
+import json
+import datetime
+import boto3
+
+TABLE_NAME = os.getenv("TABLE_NAME")
+QUEUE_URL = os.getenv("QUEUE_URL")
+SHARDS = int(os.getenv("SHARDS", "10"))
+
+BUCKET = datetime.timedelta(minutes=1)
+BUCKET_FORMAT = "%Y-%m-%dT%H:%M"
+
+# Where the first sweep starts, messages are at least this far ahead
+# when written to the table
+FIRST_SWEEP = datetime.timedelta(minutes=15)
+
+# SendMessageBatch limit and the maximum DelaySeconds
+MAX_BATCH_ENTRIES = 10
+MAX_DELAY = 900
+
+CURSOR = {"bucket": "cursor", "id": "cursor"}
+
+table = boto3.resource("dynamodb").Table(TABLE_NAME)
+sqs = boto3.client("sqs")
+
+
+def handler(aws_event, aws_context):
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    # Sweeps one bucket ahead, its messages are sent with a delay
+    # instead of up to a minute late
+    last = floor(now) + BUCKET
+
+    cursor = table.get_item(Key=CURSOR, ConsistentRead=True).get("Item")
+    if cursor is None:
+        bucket = floor(now) - FIRST_SWEEP
+    else:
+        bucket = parse(cursor["value"]) + BUCKET
+
+    # The cursor moves once a bucket is swept, a failed or unfinished
+    # sweep is picked up by the next one
+    while bucket <= last and aws_context.get_remaining_time_in_millis() > 10000:
+        for shard in range(SHARDS):
+            sweep(f"{bucket.strftime(BUCKET_FORMAT)}#{shard}", now)
+
+        table.put_item(Item={**CURSOR, "value": bucket.strftime(BUCKET_FORMAT)})
+        bucket += BUCKET
+
+
+def sweep(bucket, now):
+    items = []
+    query = {
+        "KeyConditionExpression": "#bucket = :bucket",
+        "ExpressionAttributeNames": {"#bucket": "bucket"},
+        "ExpressionAttributeValues": {":bucket": bucket},
+    }
+    while True:
+        response = table.query(**query)
+        items.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            break
+        query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    failed = []
+    for start in range(0, len(items), MAX_BATCH_ENTRIES):
+        batch = items[start : start + MAX_BATCH_ENTRIES]
+        response = sqs.send_message_batch(
+            QueueUrl=QUEUE_URL,
+            Entries=[
+                {
+                    "Id": str(index),
+                    "MessageBody": json.dumps({
+                        "publish_at": item["publish_at"],
+                        "payload": json.loads(item["payload"]),
+                    }),
+                    "DelaySeconds": delay(item["publish_at"], now),
+                }
+                for index, item in enumerate(batch)
+            ],
         )
+
+        failed_ids = set(f["Id"] for f in response.get("Failed", []))
+        failed.extend(batch[int(i)] for i in failed_ids)
+
+        with table.batch_writer() as writer:
+            for index, item in enumerate(batch):
+                if str(index) not in failed_ids:
+                    writer.delete_item(Key={"bucket": item["bucket"], "id": item["id"]})
+
+    if failed:
+        raise Exception(f"Couldn't send {len(failed)} messages of {bucket}")
+
+
+def delay(publish_at, now):
+    seconds = (parse_timestamp(publish_at) - now).total_seconds()
+    return max(0, min(MAX_DELAY, int(seconds)))
+
+
+def floor(moment):
+    return moment.replace(second=0, microsecond=0)
+
+
+def parse(bucket):
+    return datetime.datetime.strptime(bucket, BUCKET_FORMAT).replace(
+        tzinfo=datetime.timezone.utc
+    )
+
+
+def parse_timestamp(timestamp):
+    return datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+"""
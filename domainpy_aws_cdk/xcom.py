@@ -1,13 +1,19 @@
 from __future__ import annotations
 
 import abc
+import json
 import typing
 
 import constructs
 import aws_cdk as cdk
 import aws_cdk.aws_iam as cdk_iam
+import aws_cdk.aws_s3 as cdk_s3
 import aws_cdk.aws_sns as cdk_sns
+import aws_cdk.aws_sqs as cdk_sqs
+import aws_cdk.aws_events as cdk_events
+import aws_cdk.aws_kinesis as cdk_kinesis
 import aws_cdk.aws_lambda as cdk_lambda
+import aws_cdk.aws_events_targets as cdk_events_targets
 import aws_cdk.aws_sns_subscriptions as cdk_sns_subscriptions
 import aws_cdk.aws_lambda_event_sources as cdk_lambda_sources
 
@@ -15,7 +21,7 @@ from .lake import Dam
 from .context import Context
 from .eventstore import EventStore
 from .scheduler import Scheduler
-from .constructs.aws_lambda import PackageAssetCode
+from .constructs.aws_lambda import PackageAssetCode, resolve_architecture
 
 from .utils import make_unique_resource_name
 
@@ -25,18 +31,67 @@ class Stream(constructs.Construct):
         self,
         scope: constructs.Construct,
         id: str,
+        *,
+        transport: typing.Optional[StreamTransport] = None,
+        group_key: str = "trace_id",
+        claim_check: bool = False,
+        claim_check_threshold: int = 64 * 1024,
+        claim_check_expiration: typing.Optional[cdk.Duration] = None,
     ) -> None:
         super().__init__(scope, id)
 
-        self.topic = cdk_sns.Topic(
-            self,
-            "topic",
-            content_based_deduplication=False,
-            fifo=True,
-            topic_name=make_unique_resource_name(
-                [s.node.id for s in self.node.scopes] + [".fifo"], "-", "-"
-            ),
-        )
+        # Message field (stream_id, trace_id, context...) or dotted path in
+        # the event (event.order_id) ordering the messages, groups are
+        # published in parallel
+        self.group_key = group_key
+
+        # Messages over the threshold are written to the bucket and only
+        # a pointer is published, defaults to the SNS billing unit
+        self.claim_check_bucket: typing.Optional[cdk_s3.Bucket] = None
+        self.claim_check_threshold = claim_check_threshold
+        if claim_check:
+            self.claim_check_bucket = cdk_s3.Bucket(
+                self,
+                "claim_check",
+                versioned=False,
+                encryption=cdk_s3.BucketEncryption.S3_MANAGED,
+                block_public_access=cdk_s3.BlockPublicAccess.BLOCK_ALL,
+                lifecycle_rules=(
+                    [cdk_s3.LifecycleRule(expiration=claim_check_expiration)]
+                    if claim_check_expiration is not None
+                    else None
+                ),
+                auto_delete_objects=True,
+                removal_policy=cdk.RemovalPolicy.DESTROY,
+            )
+
+        self.transport = transport or SnsTransport()
+        self.transport.bind(self)
+
+    def publisher_environment(self) -> typing.Dict[str, str]:
+        environment = {
+            **self.transport.publisher_environment(),
+            "GROUP_KEY": self.group_key,
+        }
+        if self.claim_check_bucket is not None:
+            environment["CLAIM_CHECK_BUCKET"] = (
+                self.claim_check_bucket.bucket_name
+            )
+            environment["CLAIM_CHECK_THRESHOLD"] = str(
+                self.claim_check_threshold
+            )
+        return environment
+
+    def grant_publish(self, grantee: cdk_iam.IGrantable) -> None:
+        self.transport.grant_publish(grantee)
+        if self.claim_check_bucket is not None:
+            self.claim_check_bucket.grant_put(grantee)
+
+    @property
+    def topic(self) -> cdk_sns.Topic:
+        if not isinstance(self.transport, SnsTransport):
+            raise Exception("Stream transport is not SNS")
+        return self.transport.topic
 
     def add_stream_source(self, source: StreamSource) -> None:
         source.bind(self)
@@ -57,59 +112,483 @@ class StreamSubcription:
         pass
 
 
+class StreamTransport:
+    """Carries the messages of a stream from its sources to its
+    subscriptions.
+
+    Publishers get publisher_environment() and run STREAM_PUBLISHER_CODE,
+    which picks the transport from it.
+    """
+
+    @abc.abstractmethod
+    def bind(self, stream: Stream) -> None:
+        pass
+
+    @abc.abstractmethod
+    def grant_publish(self, grantee: cdk_iam.IGrantable) -> None:
+        pass
+
+    @abc.abstractmethod
+    def publisher_environment(self) -> typing.Dict[str, str]:
+        pass
+
+    @abc.abstractmethod
+    def subscribe_queue(
+        self,
+        stream: Stream,
+        scope: constructs.Construct,
+        queue: cdk_sqs.IQueue,
+        *,
+        topics: typing.Optional[typing.Sequence[str]] = None,
+    ) -> None:
+        pass
+
+    @abc.abstractmethod
+    def subscribe_dam(self, stream: Stream, dam: Dam) -> None:
+        pass
+
+
+class SnsTransport(StreamTransport):
+    """SNS topic, FIFO by default.
+
+    High throughput FIFO topics apply the throughput limits per message
+    group, see Stream group_key.
+
+    Standard topics scale past the FIFO throughput limits but only
+    deliver to standard queues, at least once and unordered, so consumers
+    deduplicate on message_id (see domainpy_aws_cdk.runtime.is_duplicate).
+    """
+
+    def __init__(
+        self, *, fifo: bool = True, high_throughput: bool = False
+    ) -> None:
+        self.fifo = fifo
+        self.high_throughput = high_throughput
+
+    def bind(self, stream: Stream) -> None:
+        self.topic = cdk_sns.Topic(
+            stream,
+            "topic",
+            content_based_deduplication=False if self.fifo else None,
+            fifo=self.fifo,
+            topic_name=make_unique_resource_name(
+                [s.node.id for s in stream.node.scopes]
+                + ([".fifo"] if self.fifo else []),
+                "-",
+                "-",
+            ),
+        )
+
+        # Throughput limits apply per message group instead of per topic
+        if self.fifo and self.high_throughput:
+            cfn_topic = typing.cast(cdk_sns.CfnTopic, self.topic.node.default_child)
+            cfn_topic.add_property_override("FifoThroughputScope", "MessageGroup")
+
+    def grant_publish(self, grantee: cdk_iam.IGrantable) -> None:
+        self.topic.grant_publish(grantee)
+
+    def publisher_environment(self) -> typing.Dict[str, str]:
+        return {
+            "TRANSPORT": "sns-fifo" if self.fifo else "sns",
+            "TRANSPORT_TARGET": self.topic.topic_arn,
+        }
+
+    def subscribe_queue(
+        self,
+        stream: Stream,
+        scope: constructs.Construct,
+        queue: cdk_sqs.IQueue,
+        *,
+        topics: typing.Optional[typing.Sequence[str]] = None,
+    ) -> None:
+        if bool(queue.fifo) != self.fifo:
+            raise Exception(
+                "SNS FIFO topics only deliver to FIFO queues and standard "
+                "topics to standard queues"
+            )
+
+        if topics is None:
+            filter_policy = None
+        else:
+            filter_policy = {
+                "topic": cdk_sns.SubscriptionFilter.string_filter(
+                    allowlist=topics
+                )
+            }
+
+        self.topic.add_subscription(
+            cdk_sns_subscriptions.SqsSubscription(
+                queue,
+                raw_message_delivery=True,
+                filter_policy=filter_policy,
+            )
+        )
+
+    def subscribe_dam(self, stream: Stream, dam: Dam) -> None:
+        # Create subscription under consuming construct in case of
+        # cross-stack subscription
+        if self.topic.stack != dam.firehose.resource.stack:
+            dam.firehose.resource.stack.add_dependency(self.topic.stack)
+
+        role = cdk_iam.Role(
+            dam,
+            f"{stream.node.id}Role",
+            assumed_by=cdk_iam.ServicePrincipal("sns.amazonaws.com"),
+        )
+        role.add_to_policy(cdk_iam.PolicyStatement(
+            actions=["firehose:PutRecord", "firehose:PutRecordBatch"],
+            resources=[dam.firehose.delivery_stream_arn]
+        ))
+
+        cdk_sns.Subscription(
+            dam,
+            stream.node.id,
+            topic=self.topic,
+            endpoint=dam.firehose.delivery_stream_arn,
+            protocol=cdk_sns.SubscriptionProtocol.FIREHOSE,
+            raw_message_delivery=True,
+            region=self.regionFromArn(dam),
+            subscription_role_arn=role.role_arn
+        )
+
+    def regionFromArn(self, dam: Dam) -> typing.Optional[str]:
+        if self.topic.stack == dam.firehose.stack:
+            return None
+        return cdk.Stack.of(self.topic).split_arn(self.topic.topic_arn, cdk.ArnFormat.SLASH_RESOURCE_NAME).region
+
+
+class KinesisTransport(StreamTransport):
+    """Kinesis data stream, on demand unless shard_count is given.
+
+    Messages are partitioned by their group, so a group keeps its order
+    within a shard. Subscriptions are fed by relay functions reading the
+    stream.
+    """
+
+    def __init__(
+        self,
+        *,
+        shard_count: typing.Optional[int] = None,
+        retention_period: typing.Optional[cdk.Duration] = None,
+        relay_batch_size: typing.Optional[int] = None,
+        relay_parallelization_factor: typing.Optional[int] = None,
+        relay_architecture: typing.Optional[cdk_lambda.Architecture] = None,
+    ) -> None:
+        self.shard_count = shard_count
+        self.retention_period = retention_period
+        self.relay_batch_size = relay_batch_size
+        self.relay_parallelization_factor = relay_parallelization_factor
+        self.relay_architecture = relay_architecture
+
+    def bind(self, stream: Stream) -> None:
+        self.stream = cdk_kinesis.Stream(
+            stream,
+            "stream",
+            shard_count=self.shard_count,
+            stream_mode=(
+                cdk_kinesis.StreamMode.ON_DEMAND
+                if self.shard_count is None
+                else cdk_kinesis.StreamMode.PROVISIONED
+            ),
+            retention_period=self.retention_period,
+        )
+
+    def grant_publish(self, grantee: cdk_iam.IGrantable) -> None:
+        self.stream.grant_write(grantee)
+
+    def publisher_environment(self) -> typing.Dict[str, str]:
+        return {
+            "TRANSPORT": "kinesis",
+            "TRANSPORT_TARGET": self.stream.stream_name,
+        }
+
+    def subscribe_queue(
+        self,
+        stream: Stream,
+        scope: constructs.Construct,
+        queue: cdk_sqs.IQueue,
+        *,
+        topics: typing.Optional[typing.Sequence[str]] = None,
+    ) -> None:
+        relay = self._create_relay(
+            stream,
+            scope,
+            environment={
+                "QUEUE_URL": queue.queue_url,
+                "QUEUE_FIFO": "true" if queue.fifo else "false",
+                "TOPICS": json.dumps(topics),
+            },
+        )
+        queue.grant_send_messages(relay)
+
+    def subscribe_dam(self, stream: Stream, dam: Dam) -> None:
+        relay = self._create_relay(
+            stream,
+            dam,
+            environment={
+                "DELIVERY_STREAM_NAME": dam.firehose.resource.ref,
+            },
+        )
+        dam.firehose.grant_put_records(relay)
+
+    def _create_relay(
+        self,
+        stream: Stream,
+        scope: constructs.Construct,
+        *,
+        environment: typing.Mapping[str, str],
+    ) -> cdk_lambda.Function:
+        architecture = resolve_architecture(scope, self.relay_architecture)
+        relay = cdk_lambda.Function(
+            scope,
+            f"{stream.node.id}Relay",
+            code=PackageAssetCode.from_python_inline(
+                KINESIS_RELAY_CODE, architecture=architecture
+            ),
+            layers=[
+                PackageAssetCode.python_layer(
+                    scope,
+                    ["aws-xray-sdk==2.8.0"],
+                    compatible_runtimes=[cdk_lambda.Runtime.PYTHON_3_8],
+                    architecture=architecture,
+                )
+            ],
+            handler="index.handler",
+            runtime=cdk_lambda.Runtime.PYTHON_3_8,
+            architecture=architecture,
+            environment=environment,
+            description="[KinesisTransport] Relay messages from stream",
+            timeout=cdk.Duration.minutes(1),
+            tracing=cdk_lambda.Tracing.ACTIVE,
+        )
+        relay.add_event_source(
+            cdk_lambda_sources.KinesisEventSource(
+                self.stream,
+                starting_position=cdk_lambda.StartingPosition.LATEST,
+                batch_size=self.relay_batch_size,
+                parallelization_factor=self.relay_parallelization_factor,
+                report_batch_item_failures=True,
+                bisect_batch_on_error=True,
+            )
+        )
+        return relay
+
+
+class EventBridgeTransport(StreamTransport):
+    """EventBridge bus, a new one unless event_bus is given.
+
+    Delivery is at least once and unordered, to standard queues only, so
+    consumers deduplicate on message_id (see
+    domainpy_aws_cdk.runtime.is_duplicate). The detail type of the events
+    is the message topic.
+    """
+
+    def __init__(
+        self, *, event_bus: typing.Optional[cdk_events.IEventBus] = None
+    ) -> None:
+        self.shared_event_bus = event_bus
+
+    def bind(self, stream: Stream) -> None:
+        self.event_bus: cdk_events.IEventBus = (
+            self.shared_event_bus or cdk_events.EventBus(stream, "bus")
+        )
+
+        # Tells apart the streams sharing a bus
+        self.source = stream.node.path
+
+    def grant_publish(self, grantee: cdk_iam.IGrantable) -> None:
+        self.event_bus.grant_put_events_to(grantee)
+
+    def publisher_environment(self) -> typing.Dict[str, str]:
+        return {
+            "TRANSPORT": "eventbridge",
+            "TRANSPORT_TARGET": self.event_bus.event_bus_name,
+            "TRANSPORT_SOURCE": self.source,
+        }
+
+    def subscribe_queue(
+        self,
+        stream: Stream,
+        scope: constructs.Construct,
+        queue: cdk_sqs.IQueue,
+        *,
+        topics: typing.Optional[typing.Sequence[str]] = None,
+    ) -> None:
+        if queue.fifo:
+            raise Exception("EventBridge streams only deliver to standard queues")
+
+        self._create_rule(stream, scope, topics=topics).add_target(
+            cdk_events_targets.SqsQueue(
+                queue, message=cdk_events.RuleTargetInput.from_event_path("$.detail")
+            )
+        )
+
+    def subscribe_dam(self, stream: Stream, dam: Dam) -> None:
+        self._create_rule(stream, dam).add_target(
+            cdk_events_targets.KinesisFirehoseStream(
+                dam.firehose.resource,
+                message=cdk_events.RuleTargetInput.from_event_path("$.detail"),
+            )
+        )
+
+    def _create_rule(
+        self,
+        stream: Stream,
+        scope: constructs.Construct,
+        *,
+        topics: typing.Optional[typing.Sequence[str]] = None,
+    ) -> cdk_events.Rule:
+        return cdk_events.Rule(
+            scope,
+            f"{stream.node.id}Rule",
+            event_bus=self.event_bus,
+            event_pattern=cdk_events.EventPattern(
+                source=[self.source],
+                detail_type=list(topics) if topics is not None else None,
+            ),
+        )
+
+
 class EventStoreSource(constructs.Construct, StreamSource):
     def __init__(
-        self, scope: constructs.Construct, id: str, eventstore: EventStore
+        self,
+        scope: constructs.Construct,
+        id: str,
+        eventstore: EventStore,
+        *,
+        max_workers: int = 8,
+        fast_json: bool = False,
+        retry_attempts: int = 10,
+        max_record_age: typing.Optional[cdk.Duration] = None,
+        batch_size: typing.Optional[int] = None,
+        max_batching_window: typing.Optional[cdk.Duration] = None,
+        parallelization_factor: typing.Optional[int] = None,
+        tumbling_window: typing.Optional[cdk.Duration] = None,
+        memory_size: typing.Optional[typing.Union[int, float]] = None,
+        timeout: typing.Optional[cdk.Duration] = None,
+        architecture: typing.Optional[cdk_lambda.Architecture] = None,
     ) -> None:
         super().__init__(scope, id)
         self.eventstore = eventstore
+        self.max_workers = max_workers
+        self.fast_json = fast_json
+        self.batch_size = batch_size
+        self.max_batching_window = max_batching_window
+        self.parallelization_factor = parallelization_factor
+        self.tumbling_window = tumbling_window
+        self.memory_size = memory_size
+        self.timeout = timeout or cdk.Duration.minutes(1)
+        self.retry_attempts = retry_attempts
+        self.max_record_age = max_record_age or cdk.Duration.days(1)
+        self.architecture = resolve_architecture(self, architecture)
+
+        # Receives the shard and sequence range of the records that
+        # couldn't be published, to be replayed from the stream
+        self.dlq = cdk_sqs.Queue(
+            self, "dlq", retention_period=cdk.Duration.days(14)
+        )
 
     def bind(self, stream: Stream) -> None:
+        requirements = ["aws-xray-sdk==2.8.0"]
+        if self.fast_json:
+            requirements.append("orjson==3.6.8")
+
+        environment = {
+            **stream.publisher_environment(),
+            "MAX_WORKERS": str(self.max_workers),
+        }
+
         function = cdk_lambda.Function(
             self,
             "function",
             code=PackageAssetCode.from_python_inline(
-                EVENT_STORE_STREAM_SOURCE_CODE,
-                requirements=["aws-xray-sdk==2.8.0"],
+                EVENT_STORE_STREAM_SOURCE_CODE, architecture=self.architecture
             ),
+            layers=[
+                PackageAssetCode.python_layer(
+                    self,
+                    requirements,
+                    compatible_runtimes=[cdk_lambda.Runtime.PYTHON_3_8],
+                    architecture=self.architecture,
+                )
+            ],
             handler="index.handler",
             runtime=cdk_lambda.Runtime.PYTHON_3_8,
-            environment={"TOPIC_ARN": stream.topic.topic_arn},
+            architecture=self.architecture,
+            environment=environment,
             description="[EventStoreSource] Publish events from eventstore into stream",
-            timeout=cdk.Duration.minutes(1),
+            memory_size=self.memory_size,
+            timeout=self.timeout,
             tracing=cdk_lambda.Tracing.ACTIVE,
         )
-        stream.topic.grant_publish(function)
+        stream.grant_publish(function)
 
         function.add_event_source(
             cdk_lambda_sources.DynamoEventSource(
                 self.eventstore.table,
                 starting_position=cdk_lambda.StartingPosition.LATEST,
+                batch_size=self.batch_size,
+                max_batching_window=self.max_batching_window,
+                parallelization_factor=self.parallelization_factor,
+                tumbling_window=self.tumbling_window,
+                report_batch_item_failures=True,
+                bisect_batch_on_error=True,
+                retry_attempts=self.retry_attempts,
+                max_record_age=self.max_record_age,
+                on_failure=cdk_lambda_sources.SqsDlq(self.dlq),
             )
         )
 
 
 class SchedulerSource(constructs.Construct, StreamSource):
     def __init__(
-        self, scope: constructs.Construct, id: str, scheduler: Scheduler
+        self,
+        scope: constructs.Construct,
+        id: str,
+        scheduler: Scheduler,
+        *,
+        batch_size: typing.Optional[int] = None,
+        max_batching_window: typing.Optional[cdk.Duration] = None,
+        architecture: typing.Optional[cdk_lambda.Architecture] = None,
     ) -> None:
         super().__init__(scope, id)
         self.scheduler = scheduler
+        self.batch_size = batch_size
+        self.max_batching_window = max_batching_window
+        self.architecture = resolve_architecture(self, architecture)
 
     def bind(self, stream: Stream) -> None:
         publisher = cdk_lambda.Function(
             self,
             "publisher",
-            code=cdk_lambda.Code.from_inline(SCHEDULER_STREAM_SOURCE_CODE),
-            environment={"TOPIC_ARN": stream.topic.topic_arn},
+            code=PackageAssetCode.from_python_inline(
+                SCHEDULER_STREAM_SOURCE_CODE, architecture=self.architecture
+            ),
+            layers=[
+                PackageAssetCode.python_layer(
+                    self,
+                    ["aws-xray-sdk==2.8.0"],
+                    compatible_runtimes=[cdk_lambda.Runtime.PYTHON_3_8],
+                    architecture=self.architecture,
+                )
+            ],
+            environment=stream.publisher_environment(),
             runtime=cdk_lambda.Runtime.PYTHON_3_8,
-            handler="handler",
+            architecture=self.architecture,
+            handler="index.handler",
             description="[SchedulerSource] Put messages from scheduler into stream",
             timeout=cdk.Duration.seconds(30),
             tracing=cdk_lambda.Tracing.ACTIVE,
         )
+        stream.grant_publish(publisher)
+
         publisher.add_event_source(
-            cdk_lambda_sources.SqsEventSource(self.scheduler.queue)
+            cdk_lambda_sources.SqsEventSource(
+                self.scheduler.queue,
+                batch_size=self.batch_size,
+                max_batching_window=self.max_batching_window,
+                report_batch_item_failures=True,
+            )
         )
 
 
@@ -124,22 +603,16 @@ class ContextSubscription(StreamSubcription):
         self.topics = topics
 
     def bind(self, stream: Stream) -> None:
-        if self.topics is None:
-            filter_policy = None
-        else:
-            filter_policy = {
-                "topic": cdk_sns.SubscriptionFilter.string_filter(
-                    allowlist=self.topics
-                )
-            }
+        stream.transport.subscribe_queue(
+            stream, self.context, self.context.queue, topics=self.topics
+        )
 
-        stream.topic.add_subscription(
-            cdk_sns_subscriptions.SqsSubscription(
-                self.context.queue,
-                raw_message_delivery=True,
-                filter_policy=filter_policy,
+        # Checked in messages are resolved with
+        # domainpy_aws_cdk.runtime.resolve_claim_check
+        if stream.claim_check_bucket is not None:
+            stream.claim_check_bucket.grant_read(
+                self.context.application.function_async
             )
-        )
 
 
 class DamSubscription(StreamSubcription):
@@ -147,119 +620,581 @@ class DamSubscription(StreamSubcription):
         self.dam = dam
 
     def bind(self, stream: Stream) -> None:
-        # Create subscription under consuming construct in case of
-        # cross-stack subscription
-        if stream.topic.stack != self.dam.firehose.resource.stack:
-            self.dam.firehose.resource.stack.add_dependency(stream.topic.stack)
+        stream.transport.subscribe_dam(stream, self.dam)
 
-        role = cdk_iam.Role(
-            self.dam,
-            f"{stream.node.id}Role",
-            assumed_by=cdk_iam.ServicePrincipal("sns.amazonaws.com"),
-        )
-        role.add_to_policy(cdk_iam.PolicyStatement(
-            actions=["firehose:PutRecord", "firehose:PutRecordBatch"],
-            resources=[self.dam.firehose.delivery_stream_arn]
-        ))
 
-        cdk_sns.Subscription(
-            self.dam,
-            stream.node.id,
-            topic=stream.topic,
-            endpoint=self.dam.firehose.delivery_stream_arn,
-            protocol=cdk_sns.SubscriptionProtocol.FIREHOSE,
-            raw_message_delivery=True,
-            region=self.regionFromArn(stream.topic),
-            subscription_role_arn=role.role_arn
-        )
+# Decodes a stream NewImage straight from the attribute value JSON into
+# the message body, numbers become floats. Uses orjson when bundled
+EVENT_STORE_RECORD_DECODER_CODE = """
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-    def regionFromArn(self, topic: cdk_sns.Topic) -> typing.Optional[str]:
-        if topic.stack == self.dam.firehose.stack:
+MESSAGE_FIELDS = (
+    "stream_id",
+    "number",
+    "topic",
+    "version",
+    "timestamp",
+    "event",
+    "is_snapshot",
+    "message_id",
+    "correlation_id",
+    "trace_id",
+    "context",
+)
+
+
+def decode(value):
+    # Attribute values have a single key, most frequent types first
+    for kind, data in value.items():
+        if kind == "S":
+            return data
+        if kind == "N":
+            return float(data)
+        if kind == "M":
+            return {k: decode(v) for k, v in data.items()}
+        if kind == "L":
+            return [decode(v) for v in data]
+        if kind == "BOOL":
+            return data
+        if kind == "NULL":
             return None
-        return cdk.Stack.of(topic).split_arn(topic.topic_arn, cdk.ArnFormat.SLASH_RESOURCE_NAME).region
+        if kind == "NS":
+            return [float(n) for n in data]
+        if kind in ("SS", "B", "BS"):
+            # Binaries are already base64 encoded in the stream record
+            return data
+        raise ValueError(f"Unknown attribute value type {kind}")
 
 
-EVENT_STORE_STREAM_SOURCE_CODE = """
-from aws_xray_sdk.core import patch_all
-patch_all()
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":"))
+
 
+def decode_message(new_image):
+    message = {name: decode(new_image[name]) for name in MESSAGE_FIELDS}
+    return message, dumps({"type": "EVENT", "message": message})
+"""
+
+
+# Publishes entries shaped as SNS PublishBatch entries through the
+# transport given by StreamTransport.publisher_environment
+STREAM_PUBLISHER_CODE = """
 import os
 import json
-import decimal
+import logging
 import boto3
-import boto3.dynamodb.types
 
-TOPIC_ARN = os.getenv("TOPIC_ARN")
+TRANSPORT = os.getenv("TRANSPORT")
+TRANSPORT_TARGET = os.getenv("TRANSPORT_TARGET")
+TRANSPORT_SOURCE = os.getenv("TRANSPORT_SOURCE")
+
+GROUP_KEY = os.getenv("GROUP_KEY", "trace_id").split(".")
+
+# Batch limits of PublishBatch, PutRecords and PutEvents
+MAX_BATCH_ENTRIES = {
+    "sns-fifo": 10, "sns": 10, "kinesis": 500, "eventbridge": 10
+}[TRANSPORT]
+MAX_BATCH_SIZE = {
+    "sns-fifo": 256 * 1024,
+    "sns": 256 * 1024,
+    "kinesis": 5 * 1024 ** 2,
+    "eventbridge": 256 * 1024,
+}[TRANSPORT]
+
+MAX_ATTEMPTS = 3
+
+transport = boto3.client({
+    "sns-fifo": "sns", "sns": "sns", "kinesis": "kinesis", "eventbridge": "events"
+}[TRANSPORT])
+
+logger = logging.getLogger()
+
+
+class PublishError(Exception):
+    def __init__(self, failed):
+        super().__init__(f"Failed to publish: {failed}")
+        self.failed = failed
+
+
+def group_of(message, default):
+    value = message
+    for name in GROUP_KEY:
+        if not isinstance(value, dict) or value.get(name) is None:
+            return default
+        value = value[name]
+
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def entry_size(entry):
+    size = len(entry["Message"].encode("utf-8"))
+    for name, attribute in entry["MessageAttributes"].items():
+        size += len(name) + len(attribute["DataType"])
+        size += len(attribute["StringValue"].encode("utf-8"))
+    return size
+
+
+def make_batches(entries):
+    # A batch holds at most one entry of each group, its entries fail
+    # independently. Each entry goes to the first batch with room after
+    # the one holding the previous entry of its group, so batches still
+    # fill up with the other groups
+    batches = []
+    sizes = []
+    next_batch_of_group = {}
+
+    for entry in entries:
+        size = entry_size(entry)
+        group = entry["MessageGroupId"]
+
+        index = next_batch_of_group.get(group, 0)
+        while index < len(batches) and (
+            len(batches[index]) == MAX_BATCH_ENTRIES
+            or sizes[index] + size > MAX_BATCH_SIZE
+        ):
+            index += 1
+        if index == len(batches):
+            batches.append([])
+            sizes.append(0)
+
+        batches[index].append(entry)
+        sizes[index] += size
+        next_batch_of_group[group] = index + 1
+
+    yield from batches
+
+
+def publish_batch(batch):
+    # Failed entries are retried before moving on to the next batch, the
+    # batch holding a single entry per group, so a group is never
+    # published out of order
+    pending = batch
+    for _ in range(MAX_ATTEMPTS):
+        failed = send(pending)
+        if not failed:
+            return
+
+        # Sender faults (e.g. an invalid message) fail on every attempt
+        sender_faults = [f for f in failed if f["SenderFault"]]
+        if sender_faults:
+            raise PublishError(sender_faults)
+
+        failed_ids = set(f["Id"] for f in failed)
+        pending = [e for e in pending if e["Id"] in failed_ids]
+
+    raise PublishError(failed)
+
+
+def send(entries):
+    # Returns the failed entries as PublishBatch does
+    if TRANSPORT == "sns-fifo":
+        response = transport.publish_batch(
+            TopicArn=TRANSPORT_TARGET, PublishBatchRequestEntries=entries
+        )
+        return response.get("Failed", [])
+
+    if TRANSPORT == "sns":
+        response = transport.publish_batch(
+            TopicArn=TRANSPORT_TARGET,
+            PublishBatchRequestEntries=[
+                {
+                    "Id": e["Id"],
+                    "Message": e["Message"],
+                    "MessageAttributes": e["MessageAttributes"],
+                }
+                for e in entries
+            ],
+        )
+        return response.get("Failed", [])
+
+    if TRANSPORT == "kinesis":
+        # Relays read the attributes and ids back from the envelope
+        response = transport.put_records(
+            StreamName=TRANSPORT_TARGET,
+            Records=[
+                {
+                    "Data": json.dumps({
+                        "attributes": {
+                            name: attribute["StringValue"]
+                            for name, attribute in e["MessageAttributes"].items()
+                        },
+                        "group": e["MessageGroupId"],
+                        "deduplication": e["MessageDeduplicationId"],
+                        "body": e["Message"],
+                    }).encode("utf-8"),
+                    "PartitionKey": e["MessageGroupId"],
+                }
+                for e in entries
+            ],
+        )
+        results = response["Records"]
+
+    elif TRANSPORT == "eventbridge":
+        response = transport.put_events(
+            Entries=[
+                {
+                    "EventBusName": TRANSPORT_TARGET,
+                    "Source": TRANSPORT_SOURCE,
+                    "DetailType": e["MessageAttributes"]["topic"]["StringValue"],
+                    "Detail": e["Message"],
+                }
+                for e in entries
+            ]
+        )
+        results = response["Entries"]
+
+    else:
+        raise Exception(f"Unknown transport {TRANSPORT}")
 
-DESERIALIZER = boto3.dynamodb.types.TypeDeserializer()
+    return [
+        {"Id": e["Id"], "SenderFault": False, "Code": r["ErrorCode"]}
+        for e, r in zip(entries, results)
+        if r.get("ErrorCode")
+    ]
+"""
+
+
+EVENT_STORE_STREAM_SOURCE_CODE = EVENT_STORE_RECORD_DECODER_CODE + STREAM_PUBLISHER_CODE + """
+from aws_xray_sdk.core import patch_all
+patch_all()
+
+import concurrent.futures
 
-sns = boto3.client("sns")
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))
 
-class JsonEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, decimal.Decimal):
-            return float(o)
-        return super().default(o)
+CLAIM_CHECK_BUCKET = os.getenv("CLAIM_CHECK_BUCKET")
+CLAIM_CHECK_THRESHOLD = int(os.getenv("CLAIM_CHECK_THRESHOLD", "65536"))
 
+s3 = boto3.client("s3") if CLAIM_CHECK_BUCKET else None
+
+# Kept across invocations of the same execution environment
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
 def handler(aws_event, aws_context):
-    for record in aws_event["Records"]:
+    records = aws_event["Records"]
+
+    # Entry ids are the index of their record, failures are reported
+    # as the first failed index
+    failures = []
+
+    entries = []
+    for index, record in enumerate(records):
         if record["eventName"] != "INSERT":
             continue
 
-        new_image = record["dynamodb"]["NewImage"]
-
-        message = {
-            "stream_id": DESERIALIZER.deserialize(new_image["stream_id"]),
-            "number": DESERIALIZER.deserialize(new_image["number"]),
-            "topic": DESERIALIZER.deserialize(new_image["topic"]),
-            "version": DESERIALIZER.deserialize(new_image["version"]),
-            "timestamp": DESERIALIZER.deserialize(new_image["timestamp"]),
-            "event": DESERIALIZER.deserialize(new_image["event"]),
-            "is_snapshot": DESERIALIZER.deserialize(new_image["is_snapshot"]),
-            "message_id": DESERIALIZER.deserialize(new_image["message_id"]),
-            "correlation_id": DESERIALIZER.deserialize(new_image["correlation_id"]),
-            "trace_id": DESERIALIZER.deserialize(new_image["trace_id"]),
-            "context": DESERIALIZER.deserialize(new_image["context"]),
-        }
+        try:
+            entries.append(
+                make_entry(str(index), record["dynamodb"]["NewImage"])
+            )
+        except Exception:
+            logger.exception("Couldn't decode record %s", index)
+            failures.append(index)
+            break
 
-        sns.publish(
-            TopicArn=TOPIC_ARN,
-            Message=json.dumps({ "type": "EVENT", "message": message}, cls=JsonEncoder),
-            MessageAttributes={
-                "topic": {
-                    "DataType": "string",
-                    "StringValue": message["topic"]
-                },
-                "context": {
-                    "DataType": "string",
-                    "StringValue": message["context"]
-                }
-            },
-            MessageDeduplicationId=message["message_id"],
-            MessageGroupId=message["trace_id"]
+    # Lanes are published concurrently, each one sequentially in record
+    # order, so messages of a group are still published in order
+    futures = [
+        executor.submit(publish_lane, lane)
+        for lane in make_lanes(entries, MAX_WORKERS)
+    ]
+    for future in futures:
+        failure = future.result()
+        if failure is not None:
+            failures.append(failure)
+
+    # The stream is checkpointed right before the first failure, records
+    # after it are sent again and dropped by the topic deduplication
+    if failures:
+        sequence_number = records[min(failures)]["dynamodb"]["SequenceNumber"]
+        return {"batchItemFailures": [{"itemIdentifier": sequence_number}]}
+
+    return {"batchItemFailures": []}
+
+
+def make_lanes(entries, count):
+    lanes = [[] for _ in range(count)]
+    lane_of_group = {}
+
+    # Groups are spread over the lanes in order of appearance, all the
+    # entries of a group land in the same lane
+    for entry in entries:
+        group = entry["MessageGroupId"]
+        if group not in lane_of_group:
+            lane_of_group[group] = len(lane_of_group) % count
+        lanes[lane_of_group[group]].append(entry)
+
+    return [lane for lane in lanes if lane]
+
+
+def publish_lane(entries):
+    failure = None
+    if CLAIM_CHECK_BUCKET:
+        entries, failure = check_in(entries)
+
+    # Stops at the first failure so the rest of the groups in the lane
+    # are not published ahead of it. Batches are not in record order, the
+    # failure is the first record among the failed and unpublished entries
+    batches = list(make_batches(entries))
+    for index, batch in enumerate(batches):
+        try:
+            publish_batch(batch)
+        except PublishError as error:
+            logger.error(str(error))
+            failed_ids = set(f["Id"] for f in error.failed)
+            unpublished = [e for e in batch if e["Id"] in failed_ids]
+        except Exception:
+            logger.exception("Couldn't publish batch")
+            unpublished = list(batch)
+        else:
+            continue
+
+        for later in batches[index + 1:]:
+            unpublished.extend(later)
+        return min(int(e["Id"]) for e in unpublished)
+
+    return failure
+
+
+def check_in(entries):
+    # Oversized messages are written to the claim check bucket and
+    # replaced by a pointer, the routing attributes are kept
+    checked = []
+    for entry in entries:
+        body = entry["Message"].encode("utf-8")
+        if len(body) <= CLAIM_CHECK_THRESHOLD:
+            checked.append(entry)
+            continue
+
+        key = f"{entry['MessageGroupId']}/{entry['MessageDeduplicationId']}.json"
+        try:
+            s3.put_object(
+                Bucket=CLAIM_CHECK_BUCKET,
+                Key=key,
+                Body=body,
+                ContentType="application/json",
+            )
+        except Exception:
+            logger.exception("Couldn't check in entry %s", entry["Id"])
+            return checked, int(entry["Id"])
+
+        pointer = {"bucket": CLAIM_CHECK_BUCKET, "key": key}
+        checked.append(
+            {**entry, "Message": dumps({"type": "EVENT", "claim_check": pointer})}
         )
+
+    return checked, None
+
+
+def make_entry(id, new_image):
+    message, body = decode_message(new_image)
+
+    return {
+        "Id": id,
+        "Message": body,
+        "MessageAttributes": {
+            "topic": {
+                "DataType": "string",
+                "StringValue": message["topic"]
+            },
+            "context": {
+                "DataType": "string",
+                "StringValue": message["context"]
+            }
+        },
+        "MessageDeduplicationId": message["message_id"],
+        "MessageGroupId": group_of(message, message["trace_id"])
+    }
+
+"""
+
+
+SCHEDULER_STREAM_SOURCE_CODE = STREAM_PUBLISHER_CODE + """
+from aws_xray_sdk.core import patch_all
+patch_all()
+
+
+def handler(aws_event, aws_context):
+    records = aws_event["Records"]
+
+    # Scheduled messages are unordered, every failed record is reported
+    failures = []
+
+    entries = []
+    for index, record in enumerate(records):
+        try:
+            entries.append(make_entry(str(index), record))
+        except Exception:
+            logger.exception("Couldn't decode record %s", record["messageId"])
+            failures.append(record["messageId"])
+
+    for batch in make_batches(entries):
+        try:
+            publish_batch(batch)
+        except PublishError as error:
+            logger.error(str(error))
+            failed_ids = set(f["Id"] for f in error.failed)
+            failures.extend(
+                records[int(e["Id"])]["messageId"]
+                for e in batch
+                if e["Id"] in failed_ids
+            )
+        except Exception:
+            logger.exception("Couldn't publish batch")
+            failures.extend(records[int(e["Id"])]["messageId"] for e in batch)
+
+    return {
+        "batchItemFailures": [{"itemIdentifier": m} for m in failures]
+    }
+
+
+def make_entry(id, record):
+    # Body is the scheduler execution input
+    payload = json.loads(record["body"])["payload"]
+
+    # Redelivered records keep their message id
+    message_id = payload.get("message_id") or record["messageId"]
+
+    attributes = {
+        "topic": {"DataType": "String", "StringValue": payload["topic"]}
+    }
+    if payload.get("context"):
+        attributes["context"] = {
+            "DataType": "String",
+            "StringValue": payload["context"],
+        }
+
+    return {
+        "Id": id,
+        "Message": json.dumps(payload),
+        "MessageAttributes": attributes,
+        "MessageDeduplicationId": message_id,
+        "MessageGroupId": group_of(
+            payload, payload.get("trace_id") or message_id
+        ),
+    }
 """
 
 
-SCHEDULER_STREAM_SOURCE_CODE = """
+KINESIS_RELAY_CODE = """
+from aws_xray_sdk.core import patch_all
+patch_all()
+
 import os
 import json
+import base64
 import boto3
 
-TOPIC_ARN = os.getenv('TOPIC_ARN')
-
-def handler(aws_event, context):
-    client = boto3.client('sns')
-    
-    client.publish(
-        TopicArn=INTEGRATION_EVENT_CHANNEL_TOPIC_ARN,
-        MessageAttributes={
-            'topic': {
-                'DataType': 'String',
-                'StringValue': aws_event['payload']['topic']
-            }
-        },
-        Message=json.dumps(aws_event['payload'])
+QUEUE_URL = os.getenv("QUEUE_URL")
+QUEUE_FIFO = os.getenv("QUEUE_FIFO") == "true"
+TOPICS = json.loads(os.getenv("TOPICS", "null"))
+DELIVERY_STREAM_NAME = os.getenv("DELIVERY_STREAM_NAME")
+
+# SendMessageBatch and PutRecordBatch limits
+if QUEUE_URL:
+    MAX_BATCH_ENTRIES = 10
+    MAX_BATCH_SIZE = 256 * 1024
+else:
+    MAX_BATCH_ENTRIES = 500
+    MAX_BATCH_SIZE = 4 * 1024 ** 2
+
+sqs = boto3.client("sqs")
+firehose = boto3.client("firehose")
+
+
+def handler(aws_event, aws_context):
+    messages = []
+    for record in aws_event["Records"]:
+        message = json.loads(base64.b64decode(record["kinesis"]["data"]))
+        if TOPICS is None or message["attributes"].get("topic") in TOPICS:
+            messages.append((record["kinesis"]["sequenceNumber"], message))
+
+    # Stops at the first failure, the stream is checkpointed right before
+    # the first record not sent, batches not being in record order, and
+    # the rest is sent again
+    batches = make_batches(messages)
+    for index, batch in enumerate(batches):
+        failed = send_to_queue(batch) if QUEUE_URL else send_to_delivery_stream(batch)
+        if failed:
+            unsent = failed + [m for later in batches[index + 1:] for m in later]
+            # Sequence numbers increase within the shard of the batch
+            sequence_number = min((s for s, _ in unsent), key=int)
+            return {"batchItemFailures": [{"itemIdentifier": sequence_number}]}
+
+    return {"batchItemFailures": []}
+
+
+def make_batches(messages):
+    # Failed entries of a batch are sent again after the rest of it, so on
+    # FIFO queues a batch holds at most one message of each group. Each
+    # message goes to the first batch with room after the one holding the
+    # previous message of its group
+    batches = []
+    sizes = []
+    next_batch_of_group = {}
+
+    for sequence_number, message in messages:
+        size = len(message["body"].encode("utf-8"))
+        group = message["group"] if QUEUE_FIFO else None
+
+        index = next_batch_of_group.get(group, 0)
+        while index < len(batches) and (
+            len(batches[index]) == MAX_BATCH_ENTRIES
+            or sizes[index] + size > MAX_BATCH_SIZE
+        ):
+            index += 1
+        if index == len(batches):
+            batches.append([])
+            sizes.append(0)
+
+        batches[index].append((sequence_number, message))
+        sizes[index] += size
+        if group is not None:
+            next_batch_of_group[group] = index + 1
+
+    return batches
+
+
+def send_to_queue(batch):
+    entries = []
+    for index, (_, message) in enumerate(batch):
+        entry = {
+            "Id": str(index),
+            "MessageBody": message["body"],
+            "MessageAttributes": {
+                name: {"DataType": "String", "StringValue": value}
+                for name, value in message["attributes"].items()
+            },
+        }
+        if QUEUE_FIFO:
+            entry["MessageGroupId"] = message["group"]
+            entry["MessageDeduplicationId"] = message["deduplication"]
+        entries.append(entry)
+
+    response = sqs.send_message_batch(QueueUrl=QUEUE_URL, Entries=entries)
+
+    return [batch[int(f["Id"])] for f in response.get("Failed", [])]
+
+
+def send_to_delivery_stream(batch):
+    response = firehose.put_record_batch(
+        DeliveryStreamName=DELIVERY_STREAM_NAME,
+        Records=[{"Data": message["body"].encode("utf-8")} for _, message in batch],
     )
+
+    return [
+        item
+        for item, result in zip(batch, response["RequestResponses"])
+        if result.get("ErrorCode")
+    ]
 """